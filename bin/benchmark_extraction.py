@@ -0,0 +1,217 @@
+import extract_mzxml as em
+import metrics
+import numpy as np
+import concurrent.futures
+import contextlib
+import tempfile
+import platform
+import argparse
+import base64
+import shutil
+import json
+import os
+
+
+def write_synthetic_mzxml(filename, scans=1000, duplicate_rate=0.5, peaks=50, ms1_every=5, seed=0):
+    """
+    writes an mzXML file that read_data() accepts
+    every ms1_every-th scan is MS1, the rest MS2 with up to peaks peaks
+    an MS2 scan repeats one of the last 20 precursor masses with probability duplicate_rate, which is what search_MS2_matches() pairs up
+    scans are 0.6 seconds apart
+    """
+    rng = np.random.default_rng(seed)
+    recent = []
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n')
+        f.write('<mzXML xmlns="http://sashimi.sourceforge.net/schema_revision/mzXML_3.2">\n')
+        f.write('<msRun scanCount="%d">\n' %scans)
+        for num in range(1, scans + 1):
+            ms_level = 1 if (num - 1) % ms1_every == 0 else 2
+            count = int(rng.integers(1, peaks + 1))
+            mz_array = np.sort(rng.uniform(50, 1999, count)).astype(np.float32)
+            intensity_array = rng.uniform(1, 1e5, count).astype(np.float32)
+            encoded = np.empty(2 * count, dtype='>f4') #m/z-int pairs in network byte order
+            encoded[0::2] = mz_array
+            encoded[1::2] = intensity_array
+
+            precursor = ''
+            if ms_level == 2:
+                if recent and rng.random() < duplicate_rate:
+                    mz = recent[int(rng.integers(len(recent)))]
+                else:
+                    mz = round(float(rng.uniform(100, 1000)), 4)
+                    recent = (recent + [mz])[-20:]
+                precursor = '<precursorMz precursorIntensity="%f" activationMethod="CID">%s</precursorMz>' %(rng.uniform(1e3, 1e6), mz)
+            f.write('<scan num="%d" msLevel="%d" peaksCount="%d" polarity="+" retentionTime="PT%.3fS" lowMz="50" highMz="2000">'
+                    '%s<peaks precision="32" byteOrder="network" contentType="m/z-int" compressionType="none" compressedLen="0">%s</peaks></scan>\n'
+                    %(num, ms_level, count, 0.6 * num, precursor, base64.b64encode(encoded.tobytes()).decode()))
+        f.write('</msRun>\n</mzXML>\n')
+
+def benchmark_file(filename, spec, max_dense_gb=2.0, trace_memory=False, rt_tol=0.10, mz_tol=0.01):
+    """
+    runs every stage of the main.py pipeline on one file, timed by metrics.StageMetrics with the prints discarded
+    returns a dict of stage name: wall_seconds, cpu_seconds, peak_rss_mb, rss_growth_mb, items (and traced_peak_mb)
+    bin_array2 and convert_to_ready2 are skipped when their dense arrays would pass max_dense_gb
+    """
+    em.VERBOSE = False
+    run = metrics.StageMetrics(filename, trace_memory=trace_memory, verbose=False)
+    skipped = {}
+    directory = tempfile.mkdtemp(prefix='benchmark_extraction_')
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            with run.stage('read_data') as record:
+                data = em.read_data(filename)
+            with run.stage('scan_table') as record:
+                table = em.scan_table(data)
+                record['items'] = len(table['id'])
+            with run.stage('find_MS2') as record:
+                id_list_ms2 = em.find_MS2(table, directory)
+                record['items'] = len(id_list_ms2)
+            with run.stage('search_MS2_matches') as record:
+                match_index_dict = em.search_MS2_matches(table, id_list_ms2, rt_tol=rt_tol, mz_tol=mz_tol)
+                record['items'] = len(match_index_dict)
+            with run.stage('get_match_scans') as record:
+                processed_dict = em.get_match_scans(data, match_index_dict, table)
+                record['items'] = scans = sum(len(items) for items in processed_dict.values())
+
+            dense_gb = scans * spec.bins * 32 / 1e9 #bin_array2() keeps python lists, about 32 bytes per bin
+            if dense_gb <= max_dense_gb:
+                with run.stage('bin_array2') as record:
+                    binned_dict = em.bin_array2(processed_dict, spec)
+                    record['items'] = scans
+                del binned_dict
+            else:
+                skipped['bin_array2'] = {'skipped':'%.1f GB dense' %dense_gb}
+            with run.stage('bin_array_sparse') as record:
+                binned_dict = em.bin_array_sparse(processed_dict, spec, dtype=np.float64)
+                record['items'] = scans
+            with run.stage('create_pairs') as record:
+                pairs_list = em.create_pairs(binned_dict)
+                record['items'] = sum(len(group) for group in pairs_list)
+            with run.stage('arrange_min_max') as record:
+                ordered_list = em.arrange_min_max(pairs_list)
+                record['items'] = pairs = sum(len(group) for group in ordered_list)
+
+            dense_gb = pairs * 2 * spec.bins * 8 / 1e9
+            if dense_gb <= max_dense_gb:
+                with run.stage('convert_to_ready2') as record:
+                    ready_array = em.convert_to_ready2(ordered_list)
+                    record['items'] = len(ready_array)
+                del ready_array
+            else:
+                skipped['convert_to_ready2'] = {'skipped':'%.1f GB dense' %dense_gb}
+            with run.stage('output_ready_stream') as record:
+                record['items'] = em.output_ready_stream(ordered_list, directory)
+            with run.stage('convert_to_ready_sparse') as record:
+                ready_dict = em.convert_to_ready_sparse(ordered_list)
+                record['items'] = int(ready_dict['shape'][0])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    stages = {}
+    for record in run.stages:
+        stages[record['stage']] = dict((key, value) for key, value in record.items() if key != 'stage')
+        following = {'get_match_scans':'bin_array2', 'arrange_min_max':'convert_to_ready2'}.get(record['stage'])
+        if following in skipped: #keep skipped stages in pipeline order
+            stages[following] = skipped[following]
+    return stages
+
+def run_config(config, spec, max_dense_gb, trace_memory):
+    """
+    generates the synthetic file of one configuration and benchmarks it
+    runs in a fresh process so the peak RSS belongs to this configuration only
+    """
+    directory = tempfile.mkdtemp(prefix='benchmark_mzxml_')
+    try:
+        filename = os.path.join(directory, 'synthetic.mzXML')
+        write_synthetic_mzxml(filename, config['scans'], config['duplicate_rate'], config['peaks'], seed=config['seed'])
+        result = dict(config)
+        result['file_mb'] = os.path.getsize(filename) / 1e6
+        result['stages'] = benchmark_file(filename, spec, max_dense_gb, trace_memory)
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def scaling(runs, stage):
+    """
+    exponent k of seconds ~ scans**k fitted over the runs, None with fewer than two timed runs
+    """
+    points = [(run['scans'], run['stages'][stage]['wall_seconds']) for run in runs
+              if stage in run['stages'] and run['stages'][stage].get('wall_seconds', 0) > 0]
+    if len(set(scans for scans, seconds in points)) < 2:
+        return None
+    scans, seconds = zip(*points)
+    return float(np.polyfit(np.log(scans), np.log(seconds), 1)[0])
+
+def compare(results, baseline):
+    """
+    print the time of every stage relative to a baseline results file
+    """
+    previous = dict(((run['scans'], run['duplicate_rate'], run['peaks']), run) for run in baseline['runs'])
+    for run in results['runs']:
+        old = previous.get((run['scans'], run['duplicate_rate'], run['peaks']))
+        if old is None:
+            continue
+        for stage, record in run['stages'].items():
+            old_record = old['stages'].get(stage, {})
+            if 'wall_seconds' in record and old_record.get('wall_seconds'):
+                print('%6d scans %-24s %8.4f s vs %8.4f s  x%.2f' %(run['scans'], stage, record['wall_seconds'],
+                                                                    old_record['wall_seconds'], record['wall_seconds'] / old_record['wall_seconds']))
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the extract_mzxml stages on synthetic mzXML files')
+    parser.add_argument('--scans', type=int, nargs='+', default=[500, 1000, 2000, 4000], help='scan counts of the scaling curve')
+    parser.add_argument('--duplicate_rate', type=float, nargs='+', default=[0.5], help='chance an MS2 scan repeats a recent precursor')
+    parser.add_argument('--peaks', type=int, nargs='+', default=[50], help='maximum peaks per spectrum')
+    parser.add_argument('--bin_width', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max_dense_gb', type=float, default=2.0, help='skip the dense stages above this size')
+    parser.add_argument('--tracemalloc', action='store_true', help='also record the peak allocation of each stage, slows down python heavy stages')
+    parser.add_argument('--output', default='benchmark_extraction.json', help='results file')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    spec = em.BinningSpec.from_width(args.bin_width)
+    configs = [{'scans':scans, 'duplicate_rate':rate, 'peaks':peaks, 'seed':args.seed}
+               for rate in args.duplicate_rate for peaks in args.peaks for scans in args.scans]
+    runs = []
+    for config in configs:
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                run = executor.submit(run_config, config, spec, args.max_dense_gb, args.tracemalloc).result()
+        except concurrent.futures.process.BrokenProcessPool: #killed, most likely out of memory
+            print('%(scans)s scans, duplicate rate %(duplicate_rate)s, %(peaks)s peaks failed' %config)
+            runs.append(dict(config, stages={}, error='benchmark process died'))
+            continue
+        runs.append(run)
+        print('%(scans)s scans, duplicate rate %(duplicate_rate)s, %(peaks)s peaks, %(file_mb).1f MB' %run)
+        for stage, record in run['stages'].items():
+            if 'skipped' in record:
+                print('    %-24s skipped, %s' %(stage, record['skipped']))
+            else:
+                print('    %-24s %8.4f s  %8.4f cpu s  %8.1f MB rss  %s items' %(stage, record['wall_seconds'], record['cpu_seconds'],
+                                                                              record['peak_rss_mb'], record.get('items', '')))
+
+    stages = []
+    for run in runs:
+        stages.extend(stage for stage in run['stages'] if stage not in stages)
+    results = {'environment':{'python':platform.python_version(), 'numpy':np.__version__, 'platform':platform.platform(),
+                              'cpu_count':os.cpu_count()},
+               'bin_width':args.bin_width,
+               'runs':runs,
+               'scaling':dict((stage, scaling(runs, stage)) for stage in stages)}
+    print('scaling exponent k of seconds ~ scans**k')
+    for stage in stages:
+        if results['scaling'][stage] is not None:
+            print('    %-24s %.2f' %(stage, results['scaling'][stage]))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('saved results to %s' %args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
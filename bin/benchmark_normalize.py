@@ -0,0 +1,55 @@
+import concat_hdf5 as ch5
+import numpy as np
+import scipy.sparse
+import argparse
+import time
+
+
+def best_time(function, repeats):
+    """
+    best wall time of function() over repeats runs
+    """
+    times = []
+    for i in range(0, repeats):
+        start_time = time.time()
+        function()
+        times.append(time.time() - start_time)
+    return min(times)
+
+def random_peaks(rows, width, peaks, seed=0):
+    """
+    block of shape (rows, 1, width) with about peaks nonzero bins per spectrum, like one half of split_reshape()
+    """
+    rng = np.random.default_rng(seed)
+    data = np.zeros((rows, 1, width))
+    for i in range(0, rows):
+        data[i, 0, rng.integers(0, width, peaks)] = rng.uniform(0, 1e5, peaks)
+    return data
+
+def main():
+    parser = argparse.ArgumentParser(description='microbenchmark normalize_block against normalize_peaks')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--width', type=int, default=200000)
+    parser.add_argument('--peaks', type=int, default=100, help='nonzero bins per spectrum')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    data = random_peaks(args.rows, args.width, args.peaks)
+    print('%s spectra of width %s with %s peaks' %(args.rows, args.width, args.peaks))
+    for norm in ['l1', 'l2', 'max']:
+        expected = ch5.normalize_peaks(data.copy(), norm)
+        result = ch5.normalize_block(data, norm)
+        print('%s max abs difference %s' %(norm, str(np.abs(expected - result).max())))
+
+        float32_data = data.astype(np.float32)
+        sparse_data = scipy.sparse.csr_matrix(data.reshape(args.rows, args.width))
+        timings = [('normalize_peaks float64', best_time(lambda: ch5.normalize_peaks(data.copy(), norm), args.repeats)),
+                    ('normalize_block float64', best_time(lambda: ch5.normalize_block(data, norm), args.repeats)),
+                    ('normalize_block float32 inplace', best_time(lambda: ch5.normalize_block(float32_data, norm, inplace=True), args.repeats)),
+                    ('normalize_block csr', best_time(lambda: ch5.normalize_block(sparse_data, norm), args.repeats))]
+        for name, seconds in timings:
+            print('%s %-32s %.4f seconds' %(norm, name, seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,160 @@
 import os
+import sys
+import time
+import zipfile
+import collections
+import concurrent.futures
 import numpy as np
+import scipy.sparse
 import h5py
+import extract_mzxml as em
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__)))) #spectra_hdf5 sits in the repository root
+from spectra_hdf5 import CHUNK_BYTES, create_csr, append_csr
 
 def extract_npz(filename):
     file = np.load(filename, allow_pickle=True)
     data = file['arr_0'] 
     return data
 
+def npz_shape(filename):
+    """
+    shape and dtype of arr_0 in a .npz read from the .npy header only
+    the array itself is not decompressed
+    """
+    with zipfile.ZipFile(filename) as archive:
+        with archive.open('arr_0.npy') as member:
+            version = np.lib.format.read_magic(member)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(member)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(member)
+    return shape, dtype
+
+def npz_spec(filename, width=None):
+    """
+    BinningSpec recorded in a ready_array2.npz or ready_sparse.npz by extract_mzxml
+    files written before the spec was recorded get the default 0-2000 range with width bins
+    """
+    with np.load(filename) as file:
+        attrs = dict((key, file[key][()]) for key in ['mz_min', 'mz_max', 'bins'] if key in file.files)
+        if width is None and 'shape' in file.files:
+            width = int(file['shape'][1])
+    return em.BinningSpec.from_attrs(attrs, bins=width)
+
+def count_rows(file_list):
+    """
+    first pass over the .npz headers
+    returns the files holding pairs, their row counts and the width of one spectrum
+    """
+    kept_files = []
+    rows = []
+    width = None
+    for filename in file_list:
+        try:
+            shape, dtype = npz_shape(filename)
+        except KeyboardInterrupt:
+            raise
+        except:
+            print('Failed to read the header of %s' %filename)
+            continue
+        if len(shape) < 3 or shape[0] == 0 or shape[1] != 2 or dtype == object:
+            print('skipping %s with shape %s' %(filename, str(shape)))
+            continue
+        if width is None:
+            width = int(np.prod(shape[2:]))
+        elif int(np.prod(shape[2:])) != width:
+            print('skipping %s, width %s does not match %s' %(filename, int(np.prod(shape[2:])), width))
+            continue
+        kept_files.append(filename)
+        rows.append(shape[0])
+    return kept_files, rows, width
+
+class PeaksWriter(object):
+    """
+    writes low_peaks and high_peaks rows into preallocated hdf5 datasets
+    a chunk holds batch_size rows but at most chunk_bytes, so large batches do not make huge gzip chunks
+    appended rows are written as soon as they fill whole chunks, the rest is buffered
+    """
+    def __init__(self, f, rows, width, batch_size=10, shape=None, attrs=None, chunk_bytes=CHUNK_BYTES):
+        self.shape = shape if shape is not None else (width,)
+        row_bytes = 4 * int(np.prod(self.shape))
+        self.chunk_rows = max(1, min(batch_size, rows, chunk_bytes // row_bytes))
+        self.datasets = []
+        for dataset_name in ['low_peaks', 'high_peaks']:
+            self.datasets.append(f.create_dataset(dataset_name,
+                                                    shape=(rows,) + self.shape,
+                                                    maxshape=(None,) + self.shape,
+                                                    chunks=(self.chunk_rows,) + self.shape,
+                                                    dtype=np.float32,
+                                                    compression='gzip'))
+            self.datasets[-1].attrs.update(attrs or {})
+        self.buffers = [[], []]
+        self.buffered = 0
+        self.written = 0
+
+    def append(self, low_peaks, high_peaks):
+        self.buffers[0].append(np.asarray(low_peaks, dtype=np.float32))
+        self.buffers[1].append(np.asarray(high_peaks, dtype=np.float32))
+        self.buffered += len(low_peaks)
+        if self.buffered >= self.chunk_rows:
+            self.flush(self.buffered - self.buffered % self.chunk_rows)
+
+    def flush(self, rows=None):
+        """
+        write the first rows buffered rows, all of them by default
+        """
+        if rows is None:
+            rows = self.buffered
+        if rows == 0:
+            return
+        for k in range(0, 2):
+            buffered = np.concatenate(self.buffers[k], axis=0)
+            self.datasets[k][self.written:self.written + rows] = buffered[:rows]
+            self.buffers[k] = [buffered[rows:]]
+        self.written += rows
+        self.buffered -= rows
+
+    def close(self):
+        """
+        write the remaining rows and trim rows that were preallocated but never filled
+        """
+        self.flush()
+        for dataset in self.datasets:
+            if dataset.shape[0] != self.written:
+                dataset.resize((self.written,) + self.shape)
+        return self.written
+
+def report_throughput(name, rows, start_time):
+    """
+    print rows per second and the size of the written file
+    """
+    runtime = time.time() - start_time
+    print('wrote %s rows in %.2f seconds (%.1f rows/s)' %(rows, runtime, rows / runtime if runtime > 0 else 0.0))
+    print('%s is %.2f MB' %(name, os.path.getsize(name) / 1e6))
+
+def extract_sparse_npz(filename):
+    """
+    read ready_sparse.npz from extract_mzxml.output_sparse()
+    returns low peaks and high peaks as scipy.sparse.csr_matrix
+    """
+    file = np.load(filename)
+    shape = tuple(file['shape'])
+    low_peaks = scipy.sparse.csr_matrix((file['low_data'], file['low_indices'], file['low_indptr']), shape=shape)
+    high_peaks = scipy.sparse.csr_matrix((file['high_data'], file['high_indices'], file['high_indptr']), shape=shape)
+    return low_peaks, high_peaks
+
+def extract_pairs_npz(filename):
+    """
+    read ready_pairs.npz from extract_mzxml.output_pairs()
+    returns the spectra as scipy.sparse.csr_matrix, the (low, high) pair index and the precursor metadata
+    """
+    file = np.load(filename)
+    shape = tuple(file['shape'])
+    spectra = scipy.sparse.csr_matrix((file['data'], file['indices'], file['indptr']), shape=shape)
+    metadata = dict((key, file[key]) for key in ['retentionTime', 'precursorMz', 'precursorIntensity'])
+    return spectra, file['pairs'], metadata
+
 def remove_blank_scans(peaks_array):
     new_peaks_array = []
     for i in range(0, len(peaks_array)):
@@ -17,12 +165,57 @@ def remove_blank_scans(peaks_array):
 def normalize_peaks(peaks_array, norm):
     """
     normalizes each array by dividing the array by the max of that array
+    one sklearn call per spectrum, normalize_block() does the same in one call
     """
     from sklearn.preprocessing import normalize
     for i in range(0, len(peaks_array)):
         peaks_array[i] = normalize(peaks_array[i], norm=norm)
     return peaks_array
 
+def normalize_block(peaks_array, norm, inplace=False):
+    """
+    normalizes every spectrum of a block in one call, the same result as normalize_peaks()
+    a spectrum is everything past the first axis of a 2D/3D array, or a row of a scipy.sparse matrix
+    norm is 'l1', 'l2' or 'max'; spectra with a zero norm are left as zeros
+    inplace=True divides a float array (or the data of a CSR matrix) without copying it
+    """
+    if scipy.sparse.issparse(peaks_array):
+        peaks_array = peaks_array.tocsr() if inplace else peaks_array.tocsr(copy=True)
+        if not np.issubdtype(peaks_array.dtype, np.floating):
+            peaks_array = peaks_array.astype(np.float64)
+        values = peaks_array.data
+        lengths = np.diff(peaks_array.indptr)
+        filled = lengths > 0
+        starts = peaks_array.indptr[:-1][filled]
+        norms = np.zeros(peaks_array.shape[0], dtype=values.dtype)
+        if len(values) > 0:
+            if norm == 'l1':
+                norms[filled] = np.add.reduceat(np.abs(values), starts)
+            elif norm == 'l2':
+                norms[filled] = np.sqrt(np.add.reduceat(values * values, starts))
+            elif norm == 'max':
+                norms[filled] = np.maximum.reduceat(np.abs(values), starts)
+            else:
+                raise ValueError("'%s' is not a supported norm" % norm)
+        norms[norms == 0.0] = 1.0
+        values /= np.repeat(norms, lengths)
+        return peaks_array
+
+    if not inplace or not np.issubdtype(peaks_array.dtype, np.floating):
+        peaks_array = np.array(peaks_array, dtype=np.result_type(peaks_array.dtype, np.float32))
+    rows = peaks_array.reshape(len(peaks_array), -1) #one spectrum per row, a copy when peaks_array is not contiguous
+    if norm == 'l1':
+        norms = np.abs(rows).sum(axis=1)
+    elif norm == 'l2':
+        norms = np.sqrt(np.einsum('ij,ij->i', rows, rows))
+    elif norm == 'max':
+        norms = np.max(np.abs(rows), axis=1)
+    else:
+        raise ValueError("'%s' is not a supported norm" % norm)
+    norms[norms == 0.0] = 1.0
+    peaks_array /= norms.reshape((-1,) + (1,) * (peaks_array.ndim - 1)) #divide peaks_array itself, not the reshape
+    return peaks_array
+
 def split_reshape(data, norm):
     """
     split data into low peak and high peak sets
@@ -30,13 +223,28 @@ def split_reshape(data, norm):
     """
     split_data = np.split(data, 2, axis=1) 
     low_peaks = split_data[0] 
-    low_peaks = normalize_peaks(low_peaks, norm) #normalize
+    low_peaks = normalize_block(low_peaks, norm, inplace=True) #normalize
     low_peaks = low_peaks.reshape(len(low_peaks), np.prod(low_peaks.shape[1:]))
     high_peaks = split_data[1]
-    high_peaks = normalize_peaks(high_peaks, norm) #normalize
+    high_peaks = normalize_block(high_peaks, norm, inplace=True) #normalize
     high_peaks = high_peaks.reshape(len(high_peaks), np.prod(high_peaks.shape[1:]))
     return low_peaks, high_peaks
 
+def split_sparse(filename, norm):
+    """
+    split a ready_array2.npz or ready_sparse.npz into normalized low peak and high peak sets
+    outputs two scipy.sparse.csr_matrix of shape (len(data), width)
+    """
+    if filename.endswith('ready_sparse.npz'):
+        low_peaks, high_peaks = extract_sparse_npz(filename)
+        low_peaks = normalize_block(low_peaks, norm, inplace=True) #normalize
+        high_peaks = normalize_block(high_peaks, norm, inplace=True) #normalize
+    else:
+        low_peaks, high_peaks = split_reshape(extract_npz(filename), norm)
+        low_peaks = scipy.sparse.csr_matrix(low_peaks)
+        high_peaks = scipy.sparse.csr_matrix(high_peaks)
+    return low_peaks.astype(np.float32), high_peaks.astype(np.float32)
+
 def split_reshape_Conv1D(data, norm):
     """
     split data into low peak and high peak sets
@@ -44,17 +252,24 @@ def split_reshape_Conv1D(data, norm):
     """
     split_data = np.split(data, 2, axis=1)
     low_peaks = split_data[0]
-    low_peaks = normalize_peaks(low_peaks, norm) #normalize
+    low_peaks = normalize_block(low_peaks, norm, inplace=True) #normalize
     low_peaks = low_peaks.reshape(len(low_peaks), np.prod(low_peaks.shape[1:]))
     low_peaks = np.expand_dims(low_peaks, axis=2)
     high_peaks = split_data[1]
-    high_peaks = normalize_peaks(high_peaks, norm) #normalize
+    high_peaks = normalize_block(high_peaks, norm, inplace=True) #normalize
     high_peaks = high_peaks.reshape(len(high_peaks), np.prod(high_peaks.shape[1:]))
     high_peaks = np.expand_dims(high_peaks, axis=2)
     return low_peaks, high_peaks
 
 #stitch all data, concatenate, save to compressed
-def stitch_npz(file_list):
+def stitch_npz(file_list, name='concated_data', streaming=False):
+    """
+    concatenate the arrays of all .npz along the first axis
+    saves name.npz, or name.npy with streaming=True
+    """
+    if streaming:
+        return stitch_npy(file_list, name + '.npy')
+
     data_list = []
     for filename in file_list:
         print('extracting and appending %s' %filename)
@@ -63,104 +278,237 @@ def stitch_npz(file_list):
 
     big_data = np.concatenate(data_list, axis=0) #concatenate here is going to take the most RAM 
 
-    np.savez_compressed('concated_data', big_data)
+    np.savez_compressed(name, big_data)
+
+def stitch_npy(file_list, name='concated_data.npy'):
+    """
+    concatenate the arrays of all .npz into one .npy without holding them all in memory
+    shapes come from the .npz headers, the .npy header is written first and each array is appended after it
+    peak memory is bounded by the largest input file
+    the result is the same array as np.concatenate in stitch_npz()
+    """
+    shapes = []
+    dtypes = []
+    for filename in file_list:
+        shape, dtype = npz_shape(filename)
+        if shapes and shape[1:] != shapes[0][1:]:
+            raise ValueError('%s has shape %s, expected (n,) + %s' %(filename, str(shape), str(shapes[0][1:])))
+        shapes.append(shape)
+        dtypes.append(dtype)
+    if not shapes:
+        raise ValueError('need at least one file to concatenate')
+    dtype = np.result_type(*dtypes)
+    if dtype == object:
+        raise ValueError('object arrays cannot be streamed to .npy, use stitch_npz()')
+
+    header = {'descr':np.lib.format.dtype_to_descr(dtype),
+            'fortran_order':False,
+            'shape':(sum(shape[0] for shape in shapes),) + tuple(shapes[0][1:])}
+    with open(name, 'wb') as output:
+        np.lib.format.write_array_header_1_0(output, header)
+        for filename in file_list:
+            print('extracting and appending %s' %filename)
+            data = extract_npz(filename)
+            np.ascontiguousarray(data, dtype=dtype).tofile(output)
+            del data
+    print('saved all data to %s' % name)
+
+def load_split(filename, norm):
+    """
+    load one .npz and split it into normalized float32 low peak and high peak sets
+    runs in the worker processes of load_files()
+    """
+    data = extract_npz(filename)
+    low_peaks, high_peaks = split_reshape(data, norm)
+    return low_peaks.astype(np.float32), high_peaks.astype(np.float32)
+
+def load_files(file_list, norm, workers=1, max_in_flight=None):
+    """
+    yield (filename, low_peaks, high_peaks) in file_list order
+    with workers > 1 the files are loaded on a process pool
+    at most max_in_flight files (2 * workers by default) are loaded but not yet consumed, which bounds memory
+    failed files are yielded with None peaks
+    """
+    if workers <= 1:
+        for filename in file_list:
+            try:
+                low_peaks, high_peaks = load_split(filename, norm)
+            except KeyboardInterrupt:
+                raise
+            except:
+                low_peaks, high_peaks = None, None
+            yield filename, low_peaks, high_peaks
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = collections.deque()
+        files = iter(file_list)
+        for filename in files:
+            in_flight.append((filename, pool.submit(load_split, filename, norm)))
+            if len(in_flight) >= max_in_flight:
+                break
+        while in_flight:
+            filename, future = in_flight.popleft()
+            try:
+                low_peaks, high_peaks = future.result()
+            except KeyboardInterrupt:
+                raise
+            except:
+                low_peaks, high_peaks = None, None
+            for next_filename in files: #keep the pool busy while this file is written
+                in_flight.append((next_filename, pool.submit(load_split, next_filename, norm)))
+                break
+            yield filename, low_peaks, high_peaks
 
 #hdf5 stitching
-def stitch_hdf5(file_list, norm, name='big_data.hdf5'):
+def stitch_hdf5(file_list, norm, name='big_data.hdf5', batch_size=10, workers=1, max_in_flight=None):
     """
     concatenate data into hdf5 format for reading from disk
     outputs one hdf5 file with two datasets
+    the row count is read from the .npz headers first so the datasets are allocated once
+    chunks hold batch_size rows to match the training batches, up to CHUNK_BYTES
+    with workers > 1 the .npz are loaded and normalized on a process pool, rows are still written in file_list order
     data in datasets will be normalized
     """
+    start_time = time.time()
+    file_list, rows, width = count_rows(file_list)
+    print('%s rows of width %s in %s files' %(sum(rows), width, len(file_list)))
+    if not file_list:
+        raise ValueError('none of the files hold pairs to stitch')
 
-    with h5py.File(name, 'w') as f: #create empty hdf5 file with two datasets
-        dataset = f.create_dataset('low_peaks', 
-                                    shape=(1, 200000), 
-                                    maxshape=(None, 200000),
-                                    compression='gzip')
-        dataset = f.create_dataset('high_peaks', 
-                                    shape=(1, 200000), 
-                                    maxshape=(None, 200000),
-                                    compression='gzip')
-        f.close()
-
-    i_prev = 0
-    len_total = 0
-    count = 0
-    for filename in file_list:
-        try:
+    spec = npz_spec(file_list[0], width)
+    with h5py.File(name, 'w') as f: #create hdf5 file with two preallocated datasets
+        writer = PeaksWriter(f, sum(rows), width, batch_size=batch_size, attrs=spec.attrs()) #attrs record the binning for ms2_model.input_size()
+        count = 0
+        for filename, low_peaks, high_peaks in load_files(file_list, norm, workers=workers, max_in_flight=max_in_flight):
             print('#%r extracting and appending %s to hdf5' %(count, filename))
-            data = extract_npz(filename)   
-            
-            size = data.shape
-            i_curr = size[0] + i_prev
-            len_total += i_curr
+            if low_peaks is None:
+                print("Failed to reshape data into hdf5")
+                continue
             count += 1
-            
-            low_peaks, high_peaks = split_reshape(data, norm) 
-            with h5py.File(name, 'a') as f:
-                dataset = f['low_peaks'] #append to low_peaks dataset
-                dataset.resize((len_total, 200000))
-                dataset[i_prev:i_curr, :] = low_peaks
-
-                dataset = f['high_peaks'] #append to high_peaks dataset
-                dataset.resize((len_total, 200000))
-                dataset[i_prev:i_curr, :] = high_peaks
-
-                f.close()
-            i_prev = i_curr
-            print('length at %s' %len_total)
-        except KeyboardInterrupt:
-            raise
-        except:
-            print("Failed to reshape data into hdf5")
-            pass
+            writer.append(low_peaks, high_peaks)
+            print('length at %s' %(writer.written + writer.buffered))
+        total = writer.close()
     print('saved all data to %s' % name)
+    report_throughput(name, total, start_time)
 
-def stitch_hdf5_Conv1D(file_list, norm, name='big_data_conv1d.hdf5'):
+def stitch_hdf5_Conv1D(file_list, norm, name='big_data_conv1d.hdf5', batch_size=10):
     """
     concatenate data into hdf5 format for reading from disk
     outputs one hdf5 file with two datasets in the shape for keras.input.Conv1D
+    the width comes from the data and the binning is recorded as attributes
     data in datasets will be normalized
     """
-    with h5py.File(name, 'w') as f: #create empty hdf5 file with two datasets
-        dataset = f.create_dataset('low_peaks', 
-                                    shape=(1, 20000, 1), 
-                                    maxshape=(None, 20000, 1),
-                                    compression='gzip')
-        dataset = f.create_dataset('high_peaks', 
-                                    shape=(1, 20000, 1), 
-                                    maxshape=(None, 20000, 1),
-                                    compression='gzip')
-        f.close()
-
-    i_prev = 0
-    len_total = 0
-    count = 0
-    for filename in file_list:
-        try:
-            print('#%r extracting and appending %s to hdf5' %(count, filename))
-            data = extract_npz(filename)
-            size = data.shape 
-            i_curr = size[0] + i_prev
-            len_total += i_curr
-            count += 1
+    start_time = time.time()
+    file_list, rows, width = count_rows(file_list)
+    if not file_list:
+        raise ValueError('none of the files hold pairs to stitch')
+    spec = npz_spec(file_list[0], width)
 
-            low_peaks, high_peaks = split_reshape_Conv1D(data, norm)
+    with h5py.File(name, 'w') as f: #create hdf5 file with two preallocated datasets
+        writer = PeaksWriter(f, sum(rows), width, batch_size=batch_size, shape=(width, 1), attrs=spec.attrs())
+        count = 0
+        for filename in file_list:
+            try:
+                print('#%r extracting and appending %s to hdf5' %(count, filename))
+                data = extract_npz(filename)
+                count += 1
 
-            with h5py.File(name, 'a') as f:
-                dataset = f['low_peaks'] #append to low_peaks dataset
-                dataset.resize((len_total, 200000, 1))
-                dataset[i_prev:i_curr, :, :] = low_peaks
+                low_peaks, high_peaks = split_reshape_Conv1D(data, norm)
+                writer.append(low_peaks, high_peaks)
+                print('length at %s' %(writer.written + writer.buffered))
+            except KeyboardInterrupt:
+                raise
+            except:
+                print("Failed to reshape data into hdf5")
+                pass
+        total = writer.close()
+    print('saved all data to %s' % name)
+    report_throughput(name, total, start_time)
 
-                dataset = f['high_peaks'] #append to high_peaks dataset
-                dataset.resize((len_total, 200000, 1))
-                dataset[i_prev:i_curr, :, :] = high_peaks
+def stitch_hdf5_sparse(file_list, norm, name='big_data_sparse.hdf5'):
+    """
+    concatenate data into hdf5 format for reading from disk
+    outputs one hdf5 file with two groups holding CSR indptr, indices and data
+    accepts ready_array2.npz and ready_sparse.npz files
+    data in datasets will be normalized
+    """
+    width = None
+    spec = None
+    count = 0
+    with h5py.File(name, 'w') as f: #create empty hdf5 file with two CSR groups
+        for dataset_name in ['low_peaks', 'high_peaks']:
+            create_csr(f, dataset_name)
 
-                f.close()
-            i_prev = i_curr
-            print('length at %s' %len_total)
-        except:
-            pass
+        for filename in file_list:
+            try:
+                print('#%r extracting and appending %s to hdf5' %(count, filename))
+                low_peaks, high_peaks = split_sparse(filename, norm)
+                if width is None:
+                    width = low_peaks.shape[1]
+                    spec = npz_spec(filename, width)
+                elif low_peaks.shape[1] != width:
+                    print('skipping %s, width %s does not match %s' %(filename, low_peaks.shape[1], width))
+                    continue
+                count += 1
+
+                for dataset_name, peaks in zip(['low_peaks', 'high_peaks'], [low_peaks, high_peaks]):
+                    append_csr(f[dataset_name], peaks.indptr, peaks.indices, peaks.data, width) #append the CSR arrays of this file
+                print('length at %s' %(f['low_peaks']['indptr'].shape[0] - 1))
+            except KeyboardInterrupt:
+                raise
+            except:
+                print("Failed to reshape data into hdf5")
+                pass
+
+        for dataset_name in ['low_peaks', 'high_peaks']:
+            f[dataset_name].attrs.update((spec or em.DEFAULT_BINNING).attrs()) #binning for ms2_model.input_size()
     print('saved all data to %s' % name)
 
+def stitch_hdf5_pairs(file_list, norm, name='big_data_pairs.hdf5'):
+    """
+    concatenate ready_pairs.npz files into one hdf5 where every spectrum is stored once
+    the 'spectra' group holds normalized CSR rows, 'pairs' holds the (low, high) spectra rows of each training pair
+    retentionTime, precursorMz and precursorIntensity describe each spectrum
+    spectra_hdf5.load_dataset() reads low_peaks and high_peaks from it through spectra_hdf5.PairedDataset
+    """
+    width = None
+    spec = None
+    count = 0
+    with h5py.File(name, 'w') as f: #create empty hdf5 file with the spectra table and pair index
+        group = create_csr(f, 'spectra')
+        f.create_dataset('pairs', shape=(0, 2), maxshape=(None, 2), dtype=np.int64, chunks=True, compression='gzip')
+        for key in ['retentionTime', 'precursorMz', 'precursorIntensity']:
+            f.create_dataset(key, shape=(0,), maxshape=(None,), dtype=np.float64, chunks=True)
+
+        for filename in file_list:
+            try:
+                print('#%r extracting and appending %s to hdf5' %(count, filename))
+                spectra, pairs, metadata = extract_pairs_npz(filename)
+                if width is None:
+                    width = spectra.shape[1]
+                    spec = npz_spec(filename, width)
+                elif spectra.shape[1] != width:
+                    print('skipping %s, width %s does not match %s' %(filename, spectra.shape[1], width))
+                    continue
+                spectra = normalize_block(spectra, norm, inplace=True).astype(np.float32) #normalize
+                count += 1
+
+                rows_prev = append_csr(group, spectra.indptr, spectra.indices, spectra.data, width)
+                for key in metadata.keys():
+                    f[key].resize((rows_prev + spectra.shape[0],))
+                    f[key][rows_prev:] = metadata[key]
+                pairs_prev = f['pairs'].shape[0]
+                f['pairs'].resize((pairs_prev + len(pairs), 2))
+                f['pairs'][pairs_prev:] = pairs + rows_prev #rows of this file follow the earlier spectra
+                print('length at %s pairs, %s spectra' %(f['pairs'].shape[0], group['indptr'].shape[0] - 1))
+            except KeyboardInterrupt:
+                raise
+            except:
+                print("Failed to reshape data into hdf5")
+                pass
+
+        group.attrs.update((spec or em.DEFAULT_BINNING).attrs()) #binning for ms2_model.input_size()
+    print('saved all data to %s' % name)
@@ -1,48 +1,228 @@
 from pyteomics import mzxml, auxiliary
 import numpy as np
 import scipy
+import tempfile
+import shutil
+import gzip
+import os
+import re
 
-def read_data(file):
+VERBOSE = True #per-match and per-scan progress prints, main.py --quiet turns them off
+
+class BinningSpec(object):
     """
-    read mzxml file using pyteomics.mzxml
+    m/z binning of the intensity arrays
+    bins equal-width bins over [mz_min, mz_max], the default is 0.01 Da over 0-2000
+    recorded with the extracted arrays and as hdf5 attributes so the models can size their input
     """
-    data = mzxml.MzXML(file)
+    def __init__(self, mz_min=0.0, mz_max=2000.0, bins=200000):
+        self.mz_min = float(mz_min)
+        self.mz_max = float(mz_max)
+        self.bins = int(bins)
+
+    @classmethod
+    def from_width(cls, bin_width, mz_min=0.0, mz_max=2000.0):
+        """
+        spec with bins of bin_width Da, e.g. 0.1 or 1
+        """
+        return cls(mz_min, mz_max, int(round((mz_max - mz_min) / bin_width)))
+
+    @classmethod
+    def from_attrs(cls, attrs, bins=None):
+        """
+        spec from attrs(), or the default range with bins bins when attrs has none
+        """
+        if 'bins' in attrs:
+            return cls(attrs['mz_min'], attrs['mz_max'], attrs['bins'])
+        return cls(bins=bins) if bins is not None else cls()
+
+    @property
+    def bin_width(self):
+        return (self.mz_max - self.mz_min) / self.bins
+
+    @property
+    def range(self):
+        return (self.mz_min, self.mz_max)
+
+    def attrs(self):
+        """
+        dictionary for hdf5 attributes and .npz entries
+        """
+        return {'mz_min':self.mz_min, 'mz_max':self.mz_max, 'bins':self.bins, 'bin_width':self.bin_width}
+
+    def __eq__(self, other):
+        return isinstance(other, BinningSpec) and (self.mz_min, self.mz_max, self.bins) == (other.mz_min, other.mz_max, other.bins)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'BinningSpec(mz_min=%r, mz_max=%r, bins=%r)' %(self.mz_min, self.mz_max, self.bins)
+
+DEFAULT_BINNING = BinningSpec()
+
+def is_gzip(file):
+    """
+    True if the file starts with the gzip magic number
+    """
+    with open(file, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+def data_format(file):
+    """
+    'mzML' or 'mzXML' from the file extension, a trailing .gz is ignored
+    the root element decides when the extension is neither
+    """
+    name = file[:-3] if file.lower().endswith('.gz') else file
+    extension = os.path.splitext(name)[1].lower()
+    if extension == '.mzml':
+        return 'mzML'
+    if extension == '.mzxml':
+        return 'mzXML'
+
+    opener = gzip.open if is_gzip(file) else open
+    with opener(file, 'rb') as f:
+        head = f.read(4096)
+    if b'<mzML' in head or b'<indexedmzML' in head:
+        return 'mzML'
+    return 'mzXML'
+
+def file_id(file):
+    """
+    name of a data file without its directory, .gz and format extension
+    """
+    name = os.path.basename(file)
+    if name.lower().endswith('.gz'):
+        name = name[:-3]
+    return os.path.splitext(name)[0]
+
+def gunzip_temp(file, tmp_dir=None):
+    """
+    decompress a gzip file into an anonymous temporary file, returned open at the start
+    the file has no name on disk, so it is gone once its handle closes, also when the process is killed
+    pyteomics seeks back to every scan it reads, which on a gzip stream decompresses from the start each time
+    """
+    output = tempfile.TemporaryFile(dir=tmp_dir)
+    with gzip.open(file, 'rb') as source:
+        shutil.copyfileobj(source, output, 1 << 20)
+    output.seek(0)
+    return output
+
+def read_data(file, tmp_dir=None):
+    """
+    read mzxml file using pyteomics.mzxml, or mzml file using pyteomics.mzml (needs psims)
+    gzip compressed files are first unpacked into a temporary file in tmp_dir (default $TMPDIR)
+    """
+    source = gunzip_temp(file, tmp_dir) if is_gzip(file) else file
+    if data_format(file) == 'mzML':
+        from pyteomics import mzml
+        data = mzml.MzML(source)
+    else:
+        data = mzxml.MzXML(source)
     print(str(file), 'has been accepted')
 
     return data
 
+def scan_header(scan):
+    """
+    scan number, msLevel, retentionTime in minutes, precursorMz and precursorIntensity of a pyteomics scan
+    reads mzXML and mzML records, the precursor values are None for MS1 scans
+    """
+    if 'msLevel' in scan: #mzXML
+        mz, intensity = None, None
+        if scan.get('precursorMz'):
+            mz = scan.get('precursorMz')[0].get('precursorMz')
+            intensity = scan.get('precursorMz')[0].get('precursorIntensity')
+        return int(scan.get('id')), scan.get('msLevel'), scan.get('retentionTime'), mz, intensity
+
+    #mzML, the scan number is in the native id e.g. 'controllerType=0 controllerNumber=1 scan=5'
+    number = re.search(r'scan=(\d+)', scan.get('id'))
+    number = int(number.group(1)) if number else scan.get('index') + 1
+    rt = scan.get('scanList').get('scan')[0].get('scan start time')
+    if getattr(rt, 'unit_info', None) in ['second', 's']:
+        rt = rt / 60
+    mz, intensity = None, None
+    precursors = scan.get('precursorList', {}).get('precursor')
+    if precursors:
+        ion = precursors[0].get('selectedIonList').get('selectedIon')[0]
+        mz = ion.get('selected ion m/z')
+        intensity = ion.get('peak intensity')
+    return number, scan.get('ms level'), rt, mz, intensity
+
+def scan_table(data):
+    """
+    collect the header of every scan in one streaming pass over the file
+    peak arrays are left encoded so only the XML is parsed
+    returns a dictionary of arrays where row i describes data[i], for mzXML and mzML alike
+    """
+    index = data.default_index
+    position = dict((key, i) for i, key in enumerate(index.keys()))
+    n = len(position)
+    table = {'id':np.zeros(n, dtype=np.int64), #scan number
+            'msLevel':np.zeros(n, dtype=np.int8), #msLevel
+            'retentionTime':np.full(n, np.nan, dtype=np.float64), #retentionTime
+            'precursorMz':np.full(n, np.nan, dtype=np.float64), #precursorMz, nan for MS1 scans
+            'precursorIntensity':np.full(n, np.nan, dtype=np.float64), #precursorIntensity, nan for MS1 scans
+            'offset':np.asarray(list(index.values()), dtype=np.int64).reshape(n)} #byte offset of the scan in the file
+
+    missing = 0 #precursors without an intensity
+    decode_binary = data.decode_binary
+    data.decode_binary = False #skip base64 decoding of the peaks
+    try:
+        data.reset()
+        for scan in data:
+            i = position[scan.get('id')]
+            number, ms_level, rt, mz, intensity = scan_header(scan)
+            table['id'][i] = number
+            table['msLevel'][i] = ms_level
+            table['retentionTime'][i] = rt
+            if mz is not None:
+                table['precursorMz'][i] = mz
+                if intensity is None: #0.0 so that search_MS2_matches() still compares the scan
+                    missing += 1
+                    intensity = 0.0
+                table['precursorIntensity'][i] = intensity
+    finally:
+        data.decode_binary = decode_binary
+        data.reset()
+    print('Collected the header of %s scans' %str(n))
+    if missing:
+        print('warning: %s precursors have no intensity, set to 0.0' %missing)
+
+    return table
+
+def get_scan_table(data):
+    """
+    return data if it is already a scan_table() or build the table from the pyteomics object
+    """
+    if isinstance(data, dict):
+        return data
+    return scan_table(data)
+
 def count_MS2(data):
     """
     count total number scans and MS2 scans in the data
+    accepts the pyteomics object or its scan_table()
     """
-    tot_ms2 = 0
-    tot_ms1 = 0
-
-    for i in range(0, len(data)):
-        for k,v in data[i].items():
-            if k == 'msLevel':
-                if v == 2:
-                    tot_ms2 += 1
-                else:
-                    tot_ms1 += 1
-    print('Total %s scans in data' %(str(len(data))))
+    table = get_scan_table(data)
+    tot_ms2 = int(np.count_nonzero(table['msLevel'] == 2))
+
+    print('Total %s scans in data' %(str(len(table['msLevel']))))
     print('Count %s MS2 scans in data' %(str(tot_ms2)))
 
 def find_MS2(data, directory):
     """
     find MS2 scans from the data
+    accepts the pyteomics object or its scan_table()
     output to a list of indexes of MS2 scans
     """
-    id_list_ms1 = []
-    id_list_ms2 = []
-    
-    for i in range(0, len(data)): #looping over all scan in the file
-        if data[i].get('msLevel') == 2:
-            id_list_ms2.append(i) #int 
-        elif data[i].get('msLevel') == 1:
-            id_list_ms1.append(i) #int
-        else:
-            print('msLevel error: could not sort dict[%s] msLevel' %(str(i)))
+    table = get_scan_table(data)
+    ms_level = table['msLevel']
+
+    id_list_ms1 = np.flatnonzero(ms_level == 1).tolist() #int
+    id_list_ms2 = np.flatnonzero(ms_level == 2).tolist() #int
+    for i in np.flatnonzero((ms_level != 1) & (ms_level != 2)):
+        print('msLevel error: could not sort dict[%s] msLevel' %(str(i)))
 
     #creating the files where this list will be stored
     filename1 = directory + '/id_list_ms1.txt'
@@ -61,22 +241,77 @@ def find_MS2(data, directory):
 def list_retentionTime_MS2(data, id_list_ms2):
     """
     list retentionTime for MS2 scans
-    used to demonstrate syntax of accessing elements in the parsed mxzml
+    accepts the pyteomics object or its scan_table()
     """
-    rt_list_ms2 = []
-
-    for i in id_list_ms2:
-        rt_list_ms2.append(data[i].get('retentionTime')) #syntax for accessing one particular key of one particular dictionary in the mzxml file
+    table = get_scan_table(data)
 
-    return rt_list_ms2
+    return table['retentionTime'][np.asarray(id_list_ms2, dtype=np.int64)].tolist()
 
 def search_MS2_matches(data, id_list_ms2, rt_tol=0.5, mz_tol=0.01):
     """
     search for same molecules in MS2 scans
+    accepts the pyteomics object or its scan_table()
     same molecules are based on mass ('precursorMz') with a tolerance (mass_tolerance)
     same molecules are found within a bin of retentionTime (rt_tolerance)
+    precursorMz is sorted once so the mass window of each scan is found by binary search
+    scans already claimed by a match are not searched again
     generates a dictionary of scan IDs mapped to a list of matching scan indexes
-    outputs a .txt and .json file for review
+    returns the same dictionary as search_MS2_matches_naive()
+    """
+    print('Beginning the search')
+    match_index_dict = {} #key is integer from id_list_m2; value is list of integers from id_list_ms2
+
+    rt_tolerance = rt_tol #retentionTime tolerance for half a minute
+    mass_tolerance = mz_tol #mass tolerance for 0.01mZ
+
+    #header fields of every MS2 scan as arrays
+    table = get_scan_table(data)
+    index_array = np.asarray(id_list_ms2, dtype=np.int64)
+    id_array = table['id'][index_array]
+    rt_array = table['retentionTime'][index_array]
+    mass_array = table['precursorMz'][index_array]
+    intensity_array = table['precursorIntensity'][index_array]
+
+    #stable sort keeps equal masses in id_list_ms2 order
+    mass_order = np.argsort(mass_array, kind='mergesort')
+    mass_sorted = mass_array[mass_order]
+
+    claimed = set() #scan indexes that already belong to a match
+    for i, k in enumerate(id_list_ms2): #looping over the scan numbers associated with MS2 scans
+        if k in claimed:
+            continue
+        rt_save = rt_array[i]
+        mass_save = mass_array[i]
+        intensity_save = intensity_array[i]
+        id_save = int(id_array[i])
+
+        #every scan inside the mass tolerance, back in id_list_ms2 order
+        low = np.searchsorted(mass_sorted, mass_save - mass_tolerance, side='left')
+        high = np.searchsorted(mass_sorted, mass_save + mass_tolerance, side='right')
+        window = np.sort(mass_order[low:high])
+
+        rt_dv = rt_array[window]
+        keep = (rt_dv <= rt_save + rt_tolerance) & (rt_dv >= rt_save - rt_tolerance)
+        keep &= intensity_array[window] >= intensity_save #greater or equal precursorIntensity than base molecule
+        v_list = index_array[window[keep]].tolist()
+        if VERBOSE:
+            for v in v_list:
+                print('Found a match: %s:%r' %(k, v))
+
+        match_index_dict[id_save] = v_list
+        claimed.update(v_list)
+        if VERBOSE:
+            print(id_save, match_index_dict[id_save])
+            print('Finished search for dict[%s]' %k)
+    return match_index_dict
+
+def search_MS2_matches_naive(data, id_list_ms2, rt_tol=0.5, mz_tol=0.01):
+    """
+    search for same molecules in MS2 scans
+    same molecules are based on mass ('precursorMz') with a tolerance (mass_tolerance)
+    same molecules are found within a bin of retentionTime (rt_tolerance)
+    generates a dictionary of scan IDs mapped to a list of matching scan indexes
+    quadratic reference implementation kept to check search_MS2_matches() against
     """
     print('Beginning the search')
     match_index_dict = {} #key is integer from id_list_m2; value is list of integers from id_list_ms2
@@ -118,33 +353,46 @@ def search_MS2_matches(data, id_list_ms2, rt_tol=0.5, mz_tol=0.01):
                         #logic error here now fixed
                         if intensity_dv >= intensity_save:
                             v_list.append(v)
-                            print('Found a match: %s:%r' %(k, v))
+                            if VERBOSE:
+                                print('Found a match: %s:%r' %(k, v))
                 
                 match_index_dict[id_save] = v_list
-            print(id_save, match_index_dict[id_save])
-            print('Finished search for dict[%s]' %k)
+            if VERBOSE:
+                print(id_save, match_index_dict[id_save])
+                print('Finished search for dict[%s]' %k)
             redun_check = False #reset redundancy check boolean
         else:
             redun_check = False #reset redundancy check boolean 
     return match_index_dict
 
-def get_match_scans(data, match_index_dict):
+def get_match_scans(data, match_index_dict, table=None):
     """
     collect the information from the data for the matching molecules
+    header fields come from scan_table(), peak arrays are decoded only for matched scans
     hierarchical dictionary
     """
+    if table is None:
+        table = scan_table(data)
+
+    #decode the matched scans in file order, a gzip file is then read front to back once
+    indices = set(int(index) for key in match_index_dict.keys() for index in match_index_dict[key])
+    peaks_dict = {}
+    for index in sorted(indices, key=lambda index: table['offset'][index]):
+        peaks = data[index] #decodes the peak arrays of this scan only
+        peaks_dict[index] = (peaks.get('m/z array').tolist(), peaks.get('intensity array').tolist())
+
     processed_dict = {}
     #loop through all the ms2 scans
     for key in match_index_dict.keys(): #key loops through scans
         
         processed_dict[int(key)] = []
         for index, i in zip(match_index_dict[key], range(0, len(match_index_dict[key]))): #where index loops through scans and i loops through samples
-            scan = int(data[index].get('id'))
-            rt = data[index].get('retentionTime')
-            intensity = data[index].get('precursorMz')[0].get('precursorIntensity')
-            mz = data[index].get('precursorMz')[0].get('precursorMz')
-            mz_array = data[index].get('m/z array').tolist()
-            intensity_array = data[index].get('intensity array').tolist()
+            index = int(index)
+            scan = int(table['id'][index])
+            rt = float(table['retentionTime'][index])
+            intensity = float(table['precursorIntensity'][index])
+            mz = float(table['precursorMz'][index])
+            mz_array, intensity_array = peaks_dict[index]
             
             processed_dict[int(key)].append({scan:{}})
             processed_dict[int(key)][i][scan] = {'retentionTime':rt, #retentionTime
@@ -155,7 +403,7 @@ def get_match_scans(data, match_index_dict):
     return processed_dict
 
 #use bin_array() for vecortizing and outputting zipped list of mz and intensity
-def bin_array(processed_dict):
+def bin_array(processed_dict, spec=DEFAULT_BINNING):
     """
     bin and zip mz array and intensity array
     mz values are binned
@@ -171,7 +419,7 @@ def bin_array(processed_dict):
             for scan in processed_dict[key][i]:
                 mz_array = processed_dict[key][i][scan].get('mz array')
                 intensity_array = processed_dict[key][i][scan].get('intensity array')
-                binned_intensity, binned_mz, _ = binned_statistic(mz_array, intensity_array, statistic='sum', bins=200000, range=(0, 2000)) #bins are integers range(0,2000)
+                binned_intensity, binned_mz, _ = binned_statistic(mz_array, intensity_array, statistic='sum', bins=spec.bins, range=spec.range) #bins of spec.bin_width over spec.range
                 binned_mz = binned_mz[:-1]
 
                 rt = processed_dict[key][i][scan].get('retentionTime')
@@ -188,7 +436,7 @@ def bin_array(processed_dict):
     return binned_dict
 
 #use bin_array2() for vectorizing and outputting only the intensity array
-def bin_array2(processed_dict):
+def bin_array2(processed_dict, spec=DEFAULT_BINNING):
     """
     bin intensity array
     mz values are binned
@@ -204,7 +452,7 @@ def bin_array2(processed_dict):
             for scan in processed_dict[key][i]:
                 mz_array = processed_dict[key][i][scan].get('mz array')
                 intensity_array = processed_dict[key][i][scan].get('intensity array')
-                binned_intensity, binned_mz, _ = binned_statistic(mz_array, intensity_array, statistic='sum', bins=200000, range=(0, 2000)) #bins are integers range(0,2000)
+                binned_intensity, binned_mz, _ = binned_statistic(mz_array, intensity_array, statistic='sum', bins=spec.bins, range=spec.range) #bins of spec.bin_width over spec.range
                 binned_mz = binned_mz[:-1]
 
                 rt = processed_dict[key][i][scan].get('retentionTime')
@@ -219,26 +467,135 @@ def bin_array2(processed_dict):
     print('successfully binned all intensity array')
     return binned_dict
 
-def create_pairs(binned_dict):
+def bin_edges(spec=DEFAULT_BINNING):
+    """
+    bin edges used by scipy.stats.binned_statistic for the same bins and range
+    """
+    return np.linspace(spec.mz_min, spec.mz_max, spec.bins + 1)
+
+def bin_sparse(mz_array, intensity_array, edges, dtype=np.float32):
+    """
+    bin one spectrum without building the dense vector
+    bin numbers follow scipy.stats.binned_statistic so densify() gives the same array as bin_array2()
+    returns (bin index, bin intensity) for the occupied bins only
+    """
+    mz_array = np.asarray(mz_array, dtype=np.float64)
+    intensity_array = np.asarray(intensity_array, dtype=np.float64)
+    bins = len(edges) - 1
+
+    bin_index = np.searchsorted(edges, mz_array, side='right') - 1
+    #values on the rightmost edge belong to the last bin, like binned_statistic
+    decimal = int(-np.log10(np.diff(edges).min())) + 6
+    on_edge = (mz_array >= edges[-1]) & (np.around(mz_array, decimal) == np.around(edges[-1], decimal))
+    bin_index[on_edge] -= 1
+    inside = (bin_index >= 0) & (bin_index < bins)
+
+    #bincount sums in input order within each bin, the same as binned_statistic
+    bin_index, inverse = np.unique(bin_index[inside], return_inverse=True)
+    bin_intensity = np.bincount(inverse.reshape(-1), weights=intensity_array[inside], minlength=len(bin_index))
+    return bin_index.astype(np.int32), bin_intensity.astype(dtype)
+
+#use bin_array_sparse() for vectorizing without materializing the dense intensity array
+def bin_array_sparse(processed_dict, spec=DEFAULT_BINNING, dtype=np.float32):
+    """
+    bin intensity array into (bin index, bin intensity) arrays
+    mz values are binned
+    intensity values are summed within the bin
+    dtype=np.float64 keeps densify() bit-identical to bin_array2()
+    returns dictionary with sparse binned intensity array
+    """
+    edges = bin_edges(spec)
+
+    binned_dict = {}
+    for key in processed_dict.keys():
+        binned_dict[key] = []
+        for i in range(0, len(processed_dict[key])):
+            for scan in processed_dict[key][i]:
+                mz_array = processed_dict[key][i][scan].get('mz array')
+                intensity_array = processed_dict[key][i][scan].get('intensity array')
+                bin_index, bin_intensity = bin_sparse(mz_array, intensity_array, edges, dtype=dtype)
+
+                rt = processed_dict[key][i][scan].get('retentionTime')
+                mz = processed_dict[key][i][scan].get('precursorMz')
+                intensity = processed_dict[key][i][scan].get('precursorIntensity')
+                binned_dict[key].append({scan:{}})
+                binned_dict[key][i][scan] = {'retentionTime':rt, #retentionTime
+                                            'precursorMz':mz, #precursorMz
+                                            'precursorIntensity':intensity, #precursorIntensity
+                                            'bin index':bin_index, #occupied bins
+                                            'bin intensity':bin_intensity, #summed intensity of the occupied bins
+                                            'bins':spec.bins} #width of the dense intensity array
+    print('successfully binned all intensity array')
+    return binned_dict
+
+def is_sparse(scan_dict):
+    """
+    check whether a binned scan comes from bin_array_sparse()
+    """
+    return 'bin index' in scan_dict
+
+def densify(scan_dict, dtype=np.float64):
+    """
+    dense intensity array of a binned scan from bin_array2() or bin_array_sparse()
+    """
+    if not is_sparse(scan_dict):
+        return np.asarray(scan_dict.get('intensity array'), dtype=dtype)
+    intensity_array = np.zeros(scan_dict.get('bins'), dtype=dtype)
+    intensity_array[scan_dict.get('bin index')] = scan_dict.get('bin intensity')
+    return intensity_array
+
+def pair_indices(n, max_pairs=None, sampling='first', rng=None):
+    """
+    index arrays (i, j) of the pairs i < j of n scans, in the order of create_pairs()
+    with max_pairs only the first max_pairs pairs or a random sample of them (kept in order) are returned
+    """
+    i_index, j_index = np.triu_indices(n, 1)
+    if max_pairs is not None and len(i_index) > max_pairs:
+        if sampling == 'first':
+            keep = slice(0, max_pairs)
+        elif sampling == 'random':
+            rng = np.random.default_rng() if rng is None else rng
+            keep = np.sort(rng.choice(len(i_index), max_pairs, replace=False))
+        else:
+            raise ValueError("sampling must be 'first' or 'random', not '%s'" %sampling)
+        i_index, j_index = i_index[keep], j_index[keep]
+    return i_index, j_index
+
+def iter_pairs(binned_dict, max_pairs=None, sampling='first', seed=None):
+    """
+    yields the pairs of one molecule group at a time, as create_pairs() does for all of them
+    max_pairs caps the pairs per group, keeping the first ones or a random sample reproducible with seed
+    pairs hold references to the scans of binned_dict, no array is copied
+    """
+    rng = np.random.default_rng(seed)
+    for key in binned_dict.keys(): #looping through all binned MS2 scans
+        scans = [item[scan] for item in binned_dict[key] for scan in item.keys() if np.count_nonzero(scan) != 0]
+        i_index, j_index = pair_indices(len(scans), max_pairs, sampling, rng)
+        yield [[scans[i], scans[j]] for i, j in zip(i_index.tolist(), j_index.tolist())]
+
+def create_pairs(binned_dict, max_pairs=None, sampling='first', seed=None):
     """
     creates pairs of scans from dict of matched scans
-    number of pairs per same molecule is n(n+1)/2 where n is number of scans
+    number of pairs per same molecule is n(n-1)/2 where n is number of scans, at most max_pairs with a cap
     returns list with paired scans
     """
-    pairs_list = []
-    for key in binned_dict.keys(): #looping through all binned MS2 scans
-        pairs = []
-        for i in range(0, len(binned_dict[key])):
-            for j in range(i+1, len(binned_dict[key])): 
-                for scan, scan2 in zip(binned_dict[key][i].keys(), binned_dict[key][j].keys()):
-                    if np.count_nonzero(scan) != 0:
-                        if np.count_nonzero(scan2):
-                            pairs.append([binned_dict[key][i][scan], binned_dict[key][j][scan2]])
-                            
-        pairs_list.append(pairs)
+    pairs_list = list(iter_pairs(binned_dict, max_pairs, sampling, seed))
     print('successfully created pairs for all matched scans')
     return pairs_list
 
+def iter_ordered(pairs_list):
+    """
+    yields each group of pairs_list arranged as in arrange_min_max(), pairs_list may be a generator
+    """
+    for group in pairs_list: #group/molecule level
+        pairs = []
+        for pair in group: #pairs per molecule level
+            if pair[0].get('precursorIntensity') <= pair[1].get('precursorIntensity'):
+                pairs.append([pair[0], pair[1]])
+            elif pair[1].get('precursorIntensity') < pair[0].get('precursorIntensity'):
+                pairs.append([pair[1], pair[0]])
+        yield pairs
+
 def arrange_min_max(pairs_list):
     """
     rearrange each match pair so that the smaller precursorIntensity is first
@@ -246,15 +603,7 @@ def arrange_min_max(pairs_list):
     input is a list
     returns list with arranged pairs
     """
-    ordered_list = []
-    for i in range(0, len(pairs_list)): #i is at the group/molecule level
-        pairs = []
-        for j in range(0, len(pairs_list[i])): #j is at the pairs per molecule level
-            if pairs_list[i][j][0].get('precursorIntensity') <= pairs_list[i][j][1].get('precursorIntensity'):
-                pairs.append([pairs_list[i][j][0], pairs_list[i][j][1]])
-            elif pairs_list[i][j][1].get('precursorIntensity') < pairs_list[i][j][0].get('precursorIntensity'):
-                pairs.append([pairs_list[i][j][1], pairs_list[i][j][0]])
-        ordered_list.append(pairs)
+    ordered_list = list(iter_ordered(pairs_list))
     len_pairs = len(pairs_list)
     len_ordered = len(ordered_list)
 
@@ -270,7 +619,8 @@ def convert_to_ready(ordered_list):
     """
     ready_list = []
     ready_list_2 = []
-    print(ordered_list)
+    if VERBOSE:
+        print(ordered_list)
     for i in range(0, len(ordered_list)): #i is at the group/molecule level
         group = []
         for j in range(0, len(ordered_list[i])): #j is at the pairs per molecule level
@@ -298,8 +648,17 @@ def convert_to_ready2(ordered_list):
     converts ordered_list into a list of structured arrays
     without dictionary keys
     renders only the mz_intensity array 
+    scans from bin_array_sparse() are written straight into the preallocated array
     conversion makes list ready as training input
     """
+    pairs_list = [pair for group in ordered_list for pair in group]
+    if len(pairs_list) > 0 and is_sparse(pairs_list[0][0]):
+        ready_array = np.zeros((len(pairs_list), 2, pairs_list[0][0].get('bins')), dtype=np.float64)
+        for j in range(0, len(pairs_list)): #j is at the pairs level
+            for k in range(0, len(pairs_list[j])): #k is at the scan per pair level
+                ready_array[j, k, pairs_list[j][k].get('bin index')] = pairs_list[j][k].get('bin intensity')
+        return ready_array
+
     ready_list = []
 
     for i in range(0, len(ordered_list)): #i is at the group/molecule level
@@ -312,6 +671,78 @@ def convert_to_ready2(ordered_list):
         ready_array = np.asarray(ready_list)
     return ready_array
 
+#use convert_to_ready_sparse() for a training file that is never dense
+def convert_to_ready_sparse(ordered_list):
+    """
+    converts ordered_list from bin_array_sparse() into CSR arrays
+    one row per pair, low scans and high scans are kept apart
+    returns dictionary of low_indptr, low_indices, low_data, high_indptr, high_indices, high_data and shape
+    """
+    pairs_list = [pair for group in ordered_list for pair in group]
+    bins = pairs_list[0][0].get('bins') if len(pairs_list) > 0 else 0
+
+    ready_dict = {'shape':np.asarray([len(pairs_list), bins], dtype=np.int64)}
+    for k, name in enumerate(['low', 'high']): #k is at the scan per pair level
+        indices = [pair[k].get('bin index') for pair in pairs_list]
+        data = [pair[k].get('bin intensity') for pair in pairs_list]
+        indptr = np.zeros(len(pairs_list) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(index) for index in indices])
+        ready_dict[name + '_indptr'] = indptr
+        ready_dict[name + '_indices'] = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+        ready_dict[name + '_data'] = np.concatenate(data) if data else np.zeros(0, dtype=np.float32)
+    return ready_dict
+
+#use convert_to_pairs() to store every spectrum once and the pairs as indices into it
+def convert_to_pairs(ordered_list):
+    """
+    converts ordered_list into a table of unique spectra and a pair index
+    a scan used in k pairs is stored once instead of k times as in convert_to_ready2()
+    spectra are CSR rows, pairs[i] holds the (low, high) rows of pair i
+    returns dictionary of indptr, indices, data, shape, retentionTime, precursorMz, precursorIntensity and pairs
+    """
+    position = {} #id of a scan dict: row
+    content = {} #header and peaks: row, for scans read back from a checkpoint as separate copies
+    spectra = []
+    pairs = []
+    for group in ordered_list: #group/molecule level
+        for pair in group: #pairs per molecule level
+            rows = []
+            for scan_dict in pair: #scan per pair level
+                row = position.get(id(scan_dict))
+                if row is None:
+                    if is_sparse(scan_dict):
+                        index = np.asarray(scan_dict.get('bin index'), dtype=np.int32)
+                        intensity = np.asarray(scan_dict.get('bin intensity'))
+                        bins = scan_dict.get('bins')
+                    else:
+                        intensity_array = np.asarray(scan_dict.get('intensity array'), dtype=np.float64)
+                        index = np.flatnonzero(intensity_array).astype(np.int32)
+                        intensity = intensity_array[index]
+                        bins = len(intensity_array)
+                    key = (scan_dict.get('retentionTime'), scan_dict.get('precursorMz'), scan_dict.get('precursorIntensity'),
+                            index.tobytes(), intensity.tobytes())
+                    row = content.get(key)
+                    if row is None:
+                        row = len(spectra)
+                        content[key] = row
+                        spectra.append((scan_dict, index, intensity, bins))
+                    position[id(scan_dict)] = row
+                rows.append(row)
+            pairs.append(rows)
+
+    bins = spectra[0][3] if spectra else 0
+    indptr = np.zeros(len(spectra) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(spectrum[1]) for spectrum in spectra])
+    ready_dict = {'shape':np.asarray([len(spectra), bins], dtype=np.int64),
+                'indptr':indptr,
+                'indices':np.concatenate([spectrum[1] for spectrum in spectra]) if spectra else np.zeros(0, dtype=np.int32),
+                'data':np.concatenate([spectrum[2] for spectrum in spectra]) if spectra else np.zeros(0, dtype=np.float32),
+                'pairs':np.asarray(pairs, dtype=np.int64).reshape(len(pairs), 2)}
+    for name in ['retentionTime', 'precursorMz', 'precursorIntensity']:
+        ready_dict[name] = np.asarray([spectrum[0].get(name) for spectrum in spectra], dtype=np.float64)
+    print('%s pairs reference %s unique spectra' %(len(pairs), len(spectra)))
+    return ready_dict
+
 def convert_to_ready3(ordered_list):
     """
     converts ordered_list into a list of structured DENSE arrays
@@ -420,11 +851,15 @@ def output_file2(in_dict, directory, binned=None, pairs=None, ordered=None):
             output.write(json)
         print('saved dict to "output.json"')
 
-def output_list(in_list, directory, two=None, ready_mass = None):
+def output_list(in_list, directory, two=None, ready_mass = None, spec=None):
+    """
+    output arrays into .npz
+    ready_array2.npz also records the BinningSpec when spec is given
+    """
     import numpy as np
     if two == True:
         filename = directory + '/ready_array2.npz'
-        np.savez_compressed(filename, in_list)
+        np.savez_compressed(filename, in_list, **(spec.attrs() if spec is not None else {}))
         print('saved ready_array2 to %s' %filename)
     elif ready_mass == True:
         filename = directory + '/ready_mass.npz'
@@ -435,6 +870,197 @@ def output_list(in_list, directory, two=None, ready_mass = None):
         np.savez_compressed(filename, in_list)
         print('saved ready_array to %s' %filename)
 
+def output_ready_stream(ordered_list, directory, spec=None, batch_size=16):
+    """
+    write ready_array2.npz a block of batch_size pairs at a time
+    holds the same array as convert_to_ready2() saved by output_list(two=True) but never builds it in memory
+    ordered_list may be a generator of groups such as iter_ordered(iter_pairs(binned_dict))
+    returns the number of pairs written
+    """
+    import zipfile
+    pairs_list = [pair for group in ordered_list for pair in group] #references only
+    if len(pairs_list) > 0:
+        scan_dict = pairs_list[0][0]
+        bins = scan_dict.get('bins') if is_sparse(scan_dict) else len(scan_dict.get('intensity array'))
+        shape = (len(pairs_list), 2, bins)
+    else:
+        shape = (0,)
+    header = {'descr':np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+            'fortran_order':False,
+            'shape':shape}
+
+    filename = directory + '/ready_array2.npz'
+    with zipfile.ZipFile(filename, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as output:
+        with output.open('arr_0.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            for start in range(0, len(pairs_list), batch_size):
+                pairs = pairs_list[start:start + batch_size]
+                block = np.zeros((len(pairs),) + shape[1:], dtype=np.float64)
+                for j in range(0, len(pairs)): #j is at the pairs level
+                    for k in range(0, 2): #k is at the scan per pair level
+                        if is_sparse(pairs[j][k]):
+                            block[j, k, pairs[j][k].get('bin index')] = pairs[j][k].get('bin intensity')
+                        else:
+                            block[j, k] = pairs[j][k].get('intensity array')
+                f.write(block) #buffer protocol, no bytes copy
+        for key, value in (spec.attrs() if spec is not None else {}).items():
+            with output.open(key + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(value))
+    print('saved ready_array2 to %s' %filename)
+    return len(pairs_list)
+
+def output_sparse(ready_dict, directory, spec=None):
+    """
+    output the CSR arrays from convert_to_ready_sparse() into ready_sparse.npz
+    records the BinningSpec when spec is given
+    """
+    filename = directory + '/ready_sparse.npz'
+    ready_dict = dict(ready_dict)
+    if spec is not None:
+        ready_dict.update(spec.attrs())
+    np.savez_compressed(filename, **ready_dict)
+    print('saved ready_sparse to %s' %filename)
+
+def output_pairs(ready_dict, directory, spec=None):
+    """
+    output the spectra and pair index from convert_to_pairs() into ready_pairs.npz
+    records the BinningSpec when spec is given
+    """
+    filename = directory + '/ready_pairs.npz'
+    ready_dict = dict(ready_dict)
+    if spec is not None:
+        ready_dict.update(spec.attrs())
+    np.savez_compressed(filename, **ready_dict)
+    print('saved ready_pairs to %s' %filename)
+
+#binary checkpoints of every stage, used by main.py to resume
+STAGE_FILES = {'match_index':'match_index', #search_MS2_matches()
+                'processed':'processed_dict', #get_match_scans()
+                'binned':'binned_dict', #bin_array2() or bin_array_sparse()
+                'pairs':'pairs_list', #create_pairs()
+                'ordered':'ordered_list'} #arrange_min_max()
+
+def pack_scans(scan_list):
+    """
+    flat arrays for a list of scan dictionaries
+    scalar fields become one column each, array fields are concatenated with an offset array
+    dense binned intensity arrays are stored as bin_array_sparse() fields
+    """
+    packed = {}
+    if len(scan_list) == 0:
+        packed['scalar_names'] = np.asarray([], dtype=str)
+        packed['array_names'] = np.asarray([], dtype=str)
+        return packed
+    entries = []
+    for scan_dict in scan_list:
+        if 'intensity array' in scan_dict and 'mz array' not in scan_dict: #dense binned scan
+            intensity_array = np.asarray(scan_dict.get('intensity array'), dtype=np.float64)
+            bin_index = np.flatnonzero(intensity_array).astype(np.int32)
+            scan_dict = dict((k, v) for k, v in scan_dict.items() if k != 'intensity array')
+            scan_dict.update({'bin index':bin_index, 'bin intensity':intensity_array[bin_index], 'bins':len(intensity_array)})
+        entries.append(scan_dict)
+
+    array_names = [k for k, v in entries[0].items() if isinstance(v, (list, tuple, np.ndarray))]
+    scalar_names = [k for k in entries[0].keys() if k not in array_names]
+    packed['scalar_names'] = np.asarray(scalar_names, dtype=str)
+    packed['array_names'] = np.asarray(array_names, dtype=str)
+    for n, name in enumerate(scalar_names):
+        packed['scalar_%d' %n] = np.asarray([entry.get(name) for entry in entries])
+    for n, name in enumerate(array_names):
+        values = [np.asarray(entry.get(name)) for entry in entries]
+        ptr = np.zeros(len(values) + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum([len(value) for value in values])
+        packed['array_%d_ptr' %n] = ptr
+        packed['array_%d_values' %n] = np.concatenate(values)
+    return packed
+
+def unpack_scans(packed):
+    """
+    list of scan dictionaries from pack_scans()
+    """
+    scalar_names = [str(name) for name in packed['scalar_names']]
+    array_names = [str(name) for name in packed['array_names']]
+    if not scalar_names and not array_names:
+        return []
+    scalars = [packed['scalar_%d' %n].tolist() for n in range(0, len(scalar_names))]
+    ptrs = [packed['array_%d_ptr' %n] for n in range(0, len(array_names))]
+    values = [packed['array_%d_values' %n] for n in range(0, len(array_names))]
+
+    scan_list = []
+    for i in range(0, len(ptrs[0]) - 1 if ptrs else len(scalars[0])):
+        scan_dict = {}
+        for name, column in zip(scalar_names, scalars):
+            scan_dict[name] = column[i]
+        for name, ptr, value in zip(array_names, ptrs, values):
+            scan_dict[name] = value[ptr[i]:ptr[i + 1]]
+        scan_list.append(scan_dict)
+    return scan_list
+
+def save_stage(stage_data, directory, stage, filename=None):
+    """
+    binary checkpoint of one stage, far smaller and faster than the .json of output_file()
+    stage is a key of STAGE_FILES; writes e.g. binned_dict.npz unless filename (ending in .npz) is given
+    returns the filename
+    """
+    packed = {'stage':np.asarray(stage)}
+    if stage == 'match_index':
+        keys = list(stage_data.keys())
+        ptr = np.zeros(len(keys) + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum([len(stage_data[key]) for key in keys])
+        packed['keys'] = np.asarray(keys, dtype=np.int64)
+        packed['ptr'] = ptr
+        packed['values'] = np.asarray([v for key in keys for v in stage_data[key]], dtype=np.int64)
+    elif stage in ['processed', 'binned']:
+        keys = list(stage_data.keys())
+        ptr = np.zeros(len(keys) + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum([len(stage_data[key]) for key in keys])
+        packed['keys'] = np.asarray(keys, dtype=np.int64)
+        packed['ptr'] = ptr
+        packed['scans'] = np.asarray([scan for key in keys for item in stage_data[key] for scan in item], dtype=np.int64)
+        packed.update(pack_scans([item[scan] for key in keys for item in stage_data[key] for scan in item]))
+    elif stage in ['pairs', 'ordered']:
+        ptr = np.zeros(len(stage_data) + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum([len(group) for group in stage_data])
+        packed['ptr'] = ptr
+        packed.update(pack_scans([scan_dict for group in stage_data for pair in group for scan_dict in pair]))
+    else:
+        raise ValueError("unknown stage '%s'" %stage)
+
+    if filename is None:
+        filename = directory + '/' + STAGE_FILES[stage] + '.npz'
+    np.savez(filename, **packed)
+    print('saved %s to %s' %(STAGE_FILES[stage], filename))
+    return filename
+
+def load_stage(filename):
+    """
+    read a checkpoint from save_stage(), .json files from output_file() and output_file2() go through unpack()
+    dense binned intensity arrays come back in the bin_array_sparse() form
+    """
+    if filename.endswith('.json'):
+        return unpack(filename)
+
+    with np.load(filename) as packed:
+        packed = dict((key, packed[key]) for key in packed.files)
+    stage = str(packed['stage'])
+    ptr = packed['ptr']
+    if stage == 'match_index':
+        values = packed['values'].tolist()
+        return dict((int(key), values[ptr[i]:ptr[i + 1]]) for i, key in enumerate(packed['keys']))
+
+    scan_list = unpack_scans(packed)
+    if stage in ['processed', 'binned']:
+        scans = packed['scans'].tolist()
+        stage_data = {}
+        for i, key in enumerate(packed['keys'].tolist()):
+            stage_data[key] = [{scans[j]:scan_list[j]} for j in range(ptr[i], ptr[i + 1])]
+        return stage_data
+
+    stage_data = []
+    for i in range(0, len(ptr) - 1):
+        stage_data.append([[scan_list[2 * j], scan_list[2 * j + 1]] for j in range(ptr[i], ptr[i + 1])])
+    return stage_data
+
 def unpack(input_dict):
     """
     unpack a dictionary that has be save in a .json file
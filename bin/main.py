@@ -1,95 +1,340 @@
 import extract_mzxml as em
+import stage_cache as sc
+import metrics
 import numpy as np
+import multiprocessing
+import collections
 import argparse
+import glob
 import time
+import csv
+import sys
+import os
 
-parser = argparse.ArgumentParser()
-parser.add_argument('data_file', help='data')
-parser.add_argument('directory', help='directory for output files')
-parser.add_argument('--match_index_file', action='store')
-parser.add_argument('--processed_dict_file', action='store')
-parser.add_argument('--binned_dict_file', action='store')
-parser.add_argument('--pairs_list_file', action='store')
-parser.add_argument('--ordered_list_file', action='store')
-
-args = parser.parse_args()
-file = args.data_file
-directory = args.directory
-match_index_file = args.match_index_file
-processed_dict_file = args.processed_dict_file
-binned_dict_file = args.binned_dict_file
-pairs_list_file = args.pairs_list_file
-ordered_list_file = args.ordered_list_file
-
-start_time = time.time()
-
-data = em.read_data(file) #reads in as a pyteomics object
-
-if args.ordered_list_file: #test the convert_to_ready2() function
-    ordered_list = em.unpack(ordered_list_file)
-    ready_array = em.convert_to_ready(ordered_list)
-    em.output_list(ready_array, directory, two=True)
-
-elif args.pairs_list_file: #test the arrange_min_max() function
-    pairs_list = em.unpack(pairs_list_file)
-    ordered_list = em.arrange_min_max(pairs_list)
-    em.output_file2(ordered_list, directory, ordered=True)
-
-elif args.binned_dict_file: #tests the create_pairs() function
-    binned_dict = em.unpack(binned_dict_file)
-    pairs_list = em.create_pairs(binned_dict)
-    em.output_file2(pairs_list, directory, pairs=True)
-
-elif args.processed_dict_file: #tests the bin_array2() function
-    processed_dict = em.unpack(processed_dict_file)
-    binned_dict = em.bin_array2(processed_dict)
-    em.output_file2(binned_dict, directory, binned=True)
-
-elif args.match_index_file: #tests the get_match_scans() function
-    match_index_dict = em.unpack(match_index_file)
-    processed_dict = em.get_match_scans(data, match_index_dict)
-    print('--- %s seconds runtime ---' %(str(time.time() - start_time)))
-    em.output_file(processed_dict, directory, processed=True)
+rt_tol = 0.10
+mz_tol = 0.01
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_file', help='data, or with --batch a quoted glob or a .txt list of files')
+    parser.add_argument('directory', help='directory for output files, or with --batch the parent of the <name>_outdir folders')
+    parser.add_argument('--match_index_file', action='store', help='resume from a .npz checkpoint or an older .json dump')
+    parser.add_argument('--processed_dict_file', action='store')
+    parser.add_argument('--binned_dict_file', action='store')
+    parser.add_argument('--pairs_list_file', action='store')
+    parser.add_argument('--ordered_list_file', action='store')
+    parser.add_argument('--checkpoints', action='store_true', help='save a .npz checkpoint of every stage of the complete run')
+    parser.add_argument('--sparse', action='store_true', help='write ready_sparse.npz instead of the dense ready_array2.npz')
+    parser.add_argument('--by_reference', action='store_true', help='write ready_pairs.npz, every spectrum once and the pairs as indices, instead of ready_array2.npz')
+    parser.add_argument('--bin_width', type=float, default=0.01, help='width of the m/z bins in Da over 0-2000')
+    parser.add_argument('--max_pairs', type=int, default=None, help='cap on the pairs made from each molecule group')
+    parser.add_argument('--pair_sampling', choices=['first', 'random'], default='first', help='which pairs are kept under --max_pairs')
+    parser.add_argument('--seed', type=int, default=0, help='seed of --pair_sampling random')
+    parser.add_argument('--cache_dir', action='store', help='content-hashed stage cache; reruns skip the stages whose inputs did not change')
+    parser.add_argument('--cache_size', type=float, default=20.0, help='size limit of the stage cache in GB, least recently used entries are evicted')
+    parser.add_argument('--metrics', action='store_true', help='save wall time, cpu time, peak memory and item counts of every stage to metrics.json and metrics.csv')
+    parser.add_argument('--trace_memory', action='store_true', help='with --metrics also record the peak allocation inside each stage (slower)')
+    parser.add_argument('--quiet', action='store_true', help='no per-match and per-scan prints')
+    parser.add_argument('--batch', action='store_true', help='extract every file of data_file, one process per file')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='files extracted at the same time in batch mode')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds before a file is stopped in batch mode')
+    parser.add_argument('--summary', action='store', help='summary csv of the batch, default <directory>/extraction_summary.csv')
+    return parser.parse_args(argv)
+
+def resume_file(file, directory, args):
+    """
+    runs one stage from the file given by a --*_file option
+    """
+    spec = em.BinningSpec.from_width(args.bin_width)
+    start_time = time.time()
+
+    data = em.read_data(file) #reads in as a pyteomics object
+
+    if args.ordered_list_file: #test the convert_to_ready2() function
+        ordered_list = em.load_stage(args.ordered_list_file)
+        em.output_ready_stream(ordered_list, directory, spec) #the ready_array2.npz of extract_file()
+
+    elif args.pairs_list_file: #test the arrange_min_max() function
+        pairs_list = em.load_stage(args.pairs_list_file)
+        ordered_list = em.arrange_min_max(pairs_list)
+        em.save_stage(ordered_list, directory, 'ordered')
+
+    elif args.binned_dict_file: #tests the create_pairs() function
+        binned_dict = em.load_stage(args.binned_dict_file)
+        pairs_list = em.create_pairs(binned_dict, args.max_pairs, args.pair_sampling, args.seed)
+        em.save_stage(pairs_list, directory, 'pairs')
+
+    elif args.processed_dict_file: #tests the bin_array2() function
+        processed_dict = em.load_stage(args.processed_dict_file)
+        binned_dict = em.bin_array2(processed_dict, spec)
+        em.save_stage(binned_dict, directory, 'binned')
+
+    elif args.match_index_file: #tests the get_match_scans() function
+        match_index_dict = em.load_stage(args.match_index_file)
+        processed_dict = em.get_match_scans(data, match_index_dict)
+        print('--- %s seconds runtime ---' %(str(time.time() - start_time)))
+        em.save_stage(processed_dict, directory, 'processed')
 
 ###NEEDS TO BE CHECKED FOR ACCURACY
-else: #complete run through
-    em.count_MS2(data) #this lines doesn't matter        
-    id_list_ms2 = em.find_MS2(data, directory) #made some adjustments, works as intended 
-    
-    match_index_dict = em.search_MS2_matches(data, id_list_ms2, rt_tol=0.10) #matches high and low spectra within the file
-    print('--- %s seconds runtime ---' %(str(time.time() - start_time)))
-    current_time = time.time() 
-    
-    processed_dict = em.get_match_scans(data, match_index_dict) 
-    print('--- %s seconds runtime ---' %(str(time.time() - current_time)))
-    current_time = time.time()
-        
-    #binned_dict = em.bin_array(processed_dict)
-    binned_dict = em.bin_array2(processed_dict) #SO THIS IS THE POINT AT WHICH THINGS BECOME SPARSE
-    print('--- %s seconds runtime ---' %(str(time.time() - current_time)))
-    current_time = time.time() 
-       
-    pairs_list = em.create_pairs(binned_dict)
-    print('--- %s seconds runtime ---' %(str(time.time() - current_time)))
-    current_time = time.time()
-    
-    ordered_list = em.arrange_min_max(pairs_list)
-    print('--- %s seconds runtime ---' %(str(time.time() - current_time)))
-    current_time = time.time()
-   
-    ready_array, ready_mass = em.convert_to_ready(ordered_list)
-    print('--- %s seconds runtime ---' %(str(time.time() - current_time)))
-    current_time = time.time()
-    em.output_list(ready_array, directory)
-    
-    print("Before New Code")
-    #ready_array = em.convert_to_ready(ordered_list)
-    #ready_array = em.convert_to_ready2(ordered_list)
-    ready_array = em.convert_to_ready2(ordered_list)
-    print(type(ready_array))
-    print('--- %s seconds runtime ---' %(str(time.time() - current_time)))
-    current_time = time.time()
-    em.output_list(ready_array, directory, two=True, ready_mass=None)
-
-print('operations complete')
+def extract_file(file, directory, args):
+    """
+    complete run through of one file
+    every stage is timed by metrics.StageMetrics, saved as metrics.json and metrics.csv with --metrics
+    returns a summary dict with the scan and pair counts
+    """
+    spec = em.BinningSpec.from_width(args.bin_width)
+    binned_dtype = np.float32 if args.sparse or args.by_reference else np.float64 #float64 keeps ready_array2 identical to bin_array2
+    start_time = time.time()
+    run = metrics.StageMetrics(file, trace_memory=args.trace_memory)
+
+    cache = None
+    keys = None
+    done, stage_data = 0, None #number of stages read back from the cache
+    if args.cache_dir:
+        with run.stage('cache_lookup') as record:
+            cache = sc.StageCache(args.cache_dir, size_limit=args.cache_size * 1e9)
+            stage_params = {'match_index':{'rt_tol':rt_tol, 'mz_tol':mz_tol},
+                            'binned':{'spec':spec.attrs(), 'dtype':np.dtype(binned_dtype).name},
+                            'pairs':{'max_pairs':args.max_pairs, 'sampling':args.pair_sampling, 'seed':args.seed}}
+            keys = cache.stage_keys(file, stage_params)
+            done, stage_data = cache.resume(keys)
+            record['items'] = done
+
+    def store(stage_data, stage):
+        """
+        checkpoint and cache the output of a stage
+        """
+        if args.checkpoints:
+            em.save_stage(stage_data, directory, stage)
+        if cache is not None:
+            cache.save(stage_data, stage, keys[sc.STAGES.index(stage)])
+
+    table = None
+    if done < 2: #get_match_scans() is the last stage that reads the file
+        with run.stage('read_data'):
+            data = em.read_data(file) #reads in as a pyteomics object
+        with run.stage('scan_table') as record:
+            table = em.scan_table(data) #one pass over the scan headers, read by the stages up to get_match_scans()
+            record['items'] = len(table['id'])
+        em.count_MS2(table) #this lines doesn't matter
+        with run.stage('find_MS2') as record:
+            id_list_ms2 = em.find_MS2(table, directory) #made some adjustments, works as intended
+            record['items'] = len(id_list_ms2)
+
+    if done < 1:
+        with run.stage('search_MS2_matches') as record:
+            match_index_dict = em.search_MS2_matches(table, id_list_ms2, rt_tol=rt_tol, mz_tol=mz_tol) #matches high and low spectra within the file
+            record['items'] = len(match_index_dict)
+        store(match_index_dict, 'match_index')
+    elif done == 1:
+        match_index_dict = stage_data
+
+    if done < 2:
+        with run.stage('get_match_scans') as record:
+            processed_dict = em.get_match_scans(data, match_index_dict, table) #decodes peaks of matched scans only
+            record['items'] = sum(len(items) for items in processed_dict.values())
+        store(processed_dict, 'processed')
+    elif done == 2:
+        processed_dict = stage_data
+
+    if done < 3:
+        with run.stage('bin_array_sparse') as record:
+            #binned_dict = em.bin_array(processed_dict)
+            #binned_dict = em.bin_array2(processed_dict)
+            binned_dict = em.bin_array_sparse(processed_dict, spec, dtype=binned_dtype)
+            record['items'] = sum(len(items) for items in binned_dict.values())
+        store(binned_dict, 'binned')
+    elif done == 3:
+        binned_dict = stage_data
+
+    if done < 4:
+        with run.stage('create_pairs') as record:
+            pairs_list = em.create_pairs(binned_dict, args.max_pairs, args.pair_sampling, args.seed) #references to the binned scans, not copies
+            record['items'] = sum(len(group) for group in pairs_list)
+        store(pairs_list, 'pairs')
+    elif done == 4:
+        pairs_list = stage_data
+
+    if done < 5:
+        with run.stage('arrange_min_max') as record:
+            ordered_list = em.arrange_min_max(pairs_list)
+            record['items'] = sum(len(group) for group in ordered_list)
+        store(ordered_list, 'ordered')
+    else:
+        ordered_list = stage_data
+
+    with run.stage('convert_to_ready') as record:
+        ready_array, ready_mass = em.convert_to_ready(ordered_list)
+        em.output_list(ready_array, directory)
+        record['items'] = len(ready_array)
+
+    if args.by_reference:
+        with run.stage('convert_to_pairs') as record:
+            ready_dict = em.convert_to_pairs(ordered_list)
+            em.output_pairs(ready_dict, directory, spec)
+            record['items'] = len(ready_dict['pairs'])
+    elif args.sparse:
+        with run.stage('convert_to_ready_sparse') as record:
+            ready_dict = em.convert_to_ready_sparse(ordered_list)
+            em.output_sparse(ready_dict, directory, spec)
+            record['items'] = int(ready_dict['shape'][0])
+    else:
+        with run.stage('output_ready_stream') as record:
+            #ready_array = em.convert_to_ready(ordered_list)
+            #ready_array = em.convert_to_ready2(ordered_list)
+            #em.output_list(ready_array, directory, two=True, ready_mass=None, spec=spec)
+            record['items'] = em.output_ready_stream(ordered_list, directory, spec) #dense pairs are written a block at a time
+
+    summary = {'scans':len(table['id']) if table is not None else None, #None when resumed past the scan headers
+               'ms2_scans':int(np.sum(table['msLevel'] == 2)) if table is not None else None,
+               'groups':len(ordered_list),
+               'pairs':sum(len(group) for group in ordered_list),
+               'runtime':time.time() - start_time}
+    if args.metrics:
+        run.to_json(os.path.join(directory, 'metrics.json'), **summary)
+        run.to_csv(os.path.join(directory, 'metrics.csv'))
+        print('saved stage metrics to %s' %os.path.join(directory, 'metrics.json'))
+    return summary
+
+def batch_files(pattern):
+    """
+    input files of a batch: lines of a .txt file list or the sorted matches of a glob
+    """
+    if pattern.endswith('.txt') and os.path.isfile(pattern):
+        with open(pattern) as f:
+            return [line.strip() for line in f if line.strip()]
+    return sorted(glob.glob(pattern))
+
+def batch_outdirs(files, directory):
+    """
+    <directory>/<file name without .gz and extension>_outdir for every file, the layout of the extractPairs NextFlow process
+    files sharing a name in different directories get the directories below their common parent in front,
+    e.g. run1_sample_outdir and run2_sample_outdir; raises ValueError if names still collide
+    """
+    ids = [em.file_id(file) for file in files]
+    paths = [os.path.abspath(file) for file in files]
+    common = os.path.commonpath([os.path.dirname(path) for path in paths]) if paths else ''
+    id_counts = collections.Counter(ids)
+    names = []
+    for file_id, path in zip(ids, paths):
+        if id_counts[file_id] > 1:
+            parents = os.path.relpath(os.path.dirname(path), common).split(os.sep)
+            file_id = '_'.join([parent for parent in parents if parent != os.curdir] + [file_id])
+        names.append(file_id)
+    duplicates = sorted(name for name, count in collections.Counter(names).items() if count > 1)
+    if duplicates:
+        raise ValueError('several input files would write to the same outdir: %s' %', '.join(duplicates))
+    return [os.path.join(directory, name + '_outdir') for name in names]
+
+def batch_worker(file, outdir, args, connection):
+    """
+    extracts one file in a child process, output is logged to <outdir>/extraction.log
+    sends (summary, error) through its own pipe, so terminating one worker never touches the results of another
+    """
+    em.VERBOSE = not args.quiet #a spawned worker imports extract_mzxml afresh, without the setting of the parent
+    with open(os.path.join(outdir, 'extraction.log'), 'w') as log:
+        sys.stdout = log
+        sys.stderr = log
+        try:
+            summary = extract_file(file, outdir, args)
+            result = (summary, None)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            result = (None, '%s: %s' %(type(e).__name__, e))
+        log.flush()
+        connection.send(result)
+        connection.close()
+
+def run_batch(files, directory, args):
+    """
+    extracts every file in its own process, at most args.processes at the same time
+    a file that raises, crashes or runs past args.timeout is recorded and the batch carries on
+    writes the summary csv and returns the summary rows in input order
+    """
+    if len(set(files)) != len(files):
+        raise ValueError('input files are listed more than once')
+    outdirs = dict(zip(files, batch_outdirs(files, directory)))
+    pending = list(files)
+    running = {} #file: (process, pipe, start time)
+    rows = {}
+    processes = max(1, args.processes or 1)
+
+    def collect(file, connection):
+        try:
+            if not connection.poll():
+                return
+            summary, error = connection.recv()
+        except (EOFError, OSError): #the worker died before sending
+            return
+        if error is None:
+            rows[file].update(summary)
+            rows[file]['status'] = 'ok'
+        else:
+            rows[file]['status'] = 'failed'
+            rows[file]['error'] = error
+
+    while pending or running:
+        while pending and len(running) < processes:
+            file = pending.pop(0)
+            outdir = outdirs[file]
+            if not os.path.isdir(outdir):
+                os.makedirs(outdir)
+            rows[file] = {'file':file, 'outdir':outdir}
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=batch_worker, args=(file, outdir, args, sender))
+            process.start()
+            sender.close() #only the worker writes
+            running[file] = (process, receiver, time.time())
+
+        for file, (process, receiver, start_time) in list(running.items()):
+            runtime = time.time() - start_time
+            collect(file, receiver) #reading the result lets a worker blocked on send finish
+            if process.is_alive():
+                if args.timeout is None or runtime < args.timeout:
+                    continue
+                process.terminate()
+                process.join()
+                if 'status' not in rows[file]:
+                    rows[file].update({'status':'timeout', 'error':'stopped after %.0f seconds' %runtime})
+            else:
+                process.join()
+                if 'status' not in rows[file]:
+                    collect(file, receiver) #the result may have arrived as the worker exited
+                if 'status' not in rows[file]:
+                    rows[file].update({'status':'failed', 'error':'exit code %s' %process.exitcode})
+            receiver.close()
+            rows[file].setdefault('runtime', runtime)
+            print('%s %s in %.1f seconds' %(file, rows[file]['status'], rows[file]['runtime']))
+            del running[file]
+        time.sleep(0.1)
+
+    rows = [rows[file] for file in files]
+    summary_file = args.summary or os.path.join(directory, 'extraction_summary.csv')
+    fields = ['file', 'outdir', 'status', 'runtime', 'scans', 'ms2_scans', 'groups', 'pairs', 'error']
+    with open(summary_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    failed = sum(1 for row in rows if row['status'] != 'ok')
+    print('extracted %s of %s files, summary saved to %s' %(len(rows) - failed, len(rows), summary_file))
+    return rows
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.quiet:
+        em.VERBOSE = False
+    if args.batch:
+        files = batch_files(args.data_file)
+        if not os.path.isdir(args.directory):
+            os.makedirs(args.directory)
+        run_batch(files, args.directory, args)
+    elif args.ordered_list_file or args.pairs_list_file or args.binned_dict_file or args.processed_dict_file or args.match_index_file:
+        resume_file(args.data_file, args.directory, args)
+    else: #complete run through
+        extract_file(args.data_file, args.directory, args)
+    print('operations complete')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import contextlib
+import tracemalloc
+import functools
+import platform
+import resource
+import json
+import time
+import csv
+import os
+
+FIELDS = ['stage', 'wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'rss_growth_mb', 'traced_peak_mb', 'items']
+
+def peak_rss_mb():
+    """
+    peak resident memory of this process so far in MB (ru_maxrss is in kilobytes on linux, bytes on macOS)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        return peak / 1024.0 / 1024.0
+    return peak / 1024.0
+
+class StageMetrics(object):
+    """
+    wall time, cpu time, peak memory and item counts of the stages of one run
+    stages are timed with the stage() context manager or the timed() decorator and saved with to_json() and to_csv()
+    peak_rss_mb is the process peak after a stage and rss_growth_mb how much the stage raised it;
+    trace_memory=True also records the peak python/numpy allocation inside each stage (slower)
+    """
+    def __init__(self, name=None, trace_memory=False, verbose=True):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.stages = []
+        self.start_time = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        times the block as stage name, the yielded record takes extra fields such as record['items']
+        """
+        record = {'stage':name}
+        if self.trace_memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+            else: #python < 3.9, restarting clears the traces and with them the peak
+                tracemalloc.stop()
+                tracemalloc.start()
+            traced_start = tracemalloc.get_traced_memory()[0]
+        rss_start = peak_rss_mb()
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = time.perf_counter() - start_time
+            record['cpu_seconds'] = time.process_time() - start_cpu
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['rss_growth_mb'] = record['peak_rss_mb'] - rss_start
+            if self.trace_memory:
+                record['traced_peak_mb'] = (tracemalloc.get_traced_memory()[1] - traced_start) / 1e6
+            self.stages.append(record)
+            if self.verbose:
+                print('--- %s: %.3f seconds runtime, %.1f MB peak ---' %(name, record['wall_seconds'], record['peak_rss_mb']))
+
+    def timed(self, name=None, items=None):
+        """
+        decorator timing every call of a function as stage name (default the function name)
+        items(result) gives the item count of the call
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or function.__name__) as record:
+                    result = function(*args, **kwargs)
+                    if items is not None:
+                        record['items'] = items(result)
+                return result
+            return wrapper
+        return decorator
+
+    def get(self, name):
+        """
+        record of the last stage called name or None
+        """
+        for record in reversed(self.stages):
+            if record['stage'] == name:
+                return record
+        return None
+
+    def summary(self):
+        """
+        dictionary of the run: name, host, totals and the stage records
+        """
+        return {'name':self.name,
+                'host':platform.node(),
+                'workdir':os.getcwd(), #the task directory under NextFlow, joins with the trace 'workdir' column
+                'pid':os.getpid(),
+                'start_time':self.start_time,
+                'wall_seconds':sum(record['wall_seconds'] for record in self.stages),
+                'cpu_seconds':sum(record['cpu_seconds'] for record in self.stages),
+                'peak_rss_mb':peak_rss_mb(),
+                'stages':self.stages}
+
+    def to_json(self, filename, **extra):
+        """
+        save summary() with any extra fields as json
+        """
+        summary = self.summary()
+        summary.update(extra)
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return filename
+
+    def to_csv(self, filename):
+        """
+        save one row per stage, extra record fields are appended as columns
+        """
+        fields = list(FIELDS)
+        for record in self.stages:
+            fields.extend(key for key in record if key not in fields)
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['name'] + fields)
+            writer.writeheader()
+            for record in self.stages:
+                writer.writerow(dict(record, name=self.name))
+        return filename
@@ -9,6 +9,10 @@ parser.add_argument('data_name', help='name of the data file being concatenated,
 parser.add_argument('--name', default='big_data.hdf5', help='name of the resulting data file')
 parser.add_argument('--norm', default='l2', help='the norm to use to normalize data')
 parser.add_argument('--conv1d', default='False', help="do/don't reshape for Conv1D")
+parser.add_argument('--sparse', action='store_true', help='store the datasets as CSR indptr/indices/data groups')
+parser.add_argument('--batch_size', type=int, default=10, help='training batch size, sets the rows per hdf5 chunk (at most 2 MB)')
+parser.add_argument('--workers', type=int, default=1, help='processes loading and normalizing .npz files')
+parser.add_argument('--max_in_flight', type=int, default=None, help='loaded .npz files waiting to be written, bounds memory (default 2 * workers)')
 
 args = parser.parse_args()
 path = args.data_path
@@ -17,9 +21,15 @@ name = args.name
 norm = args.norm
 conv1d = args.conv1d
 
-file_list = glob.glob(os.path.join(args.data_path, "**/{}".format(data_name)), recursive=True)
+file_list = sorted(glob.glob(os.path.join(args.data_path, "**/{}".format(data_name)), recursive=True))
 
-ch5.stitch_hdf5(file_list, norm=norm, name=name) #data in autoencoder format
+if data_name.endswith('ready_pairs.npz'):
+    ch5.stitch_hdf5_pairs(file_list, norm=norm, name=name) #every spectrum once, pairs as indices, read by spectra_hdf5.PairedDataset
+elif args.sparse:
+    ch5.stitch_hdf5_sparse(file_list, norm=norm, name=name) #data in CSR format, densified per batch by spectra_hdf5.SparseDataset
+else:
+    ch5.stitch_hdf5(file_list, norm=norm, name=name, batch_size=args.batch_size,
+                    workers=args.workers, max_in_flight=args.max_in_flight) #data in autoencoder format
 #filename = name[:name.rfind('.')] + '_conv1d' + name[name.rfind('.'):]
 #ch5.stitch_hdf5_Conv1D(file_list, norm=norm, name=filename) #data in conv1d format
 print('operations complete')
@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import extract_mzxml as em
+
+STAGES = ['match_index', 'processed', 'binned', 'pairs', 'ordered'] #order of the complete run in main.py
+CACHE_VERSION = 1 #bump when the checkpoint format of save_stage() changes
+
+def file_hash(filename, block_size=1 << 20):
+    """
+    sha1 of the contents of a file, read in blocks
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            sha.update(block)
+            block = f.read(block_size)
+    return sha.hexdigest()
+
+def code_hash():
+    """
+    sha1 of the extract_mzxml.py source, so that edits to the stages invalidate the cache
+    """
+    source = os.path.splitext(em.__file__)[0] + '.py'
+    return file_hash(source)
+
+class StageCache:
+    """
+    content-hashed cache of the main.py stages
+    every stage is saved with save_stage() under a key chained from the input file hash,
+    the parameters of every stage up to it and the extract_mzxml.py source
+    least recently used entries are removed once the cache grows past size_limit bytes
+    """
+    def __init__(self, cache_dir, size_limit=None):
+        self.cache_dir = cache_dir
+        self.size_limit = size_limit
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def input_hash(self, filename):
+        """
+        file_hash() of an input file, remembered by path, size and mtime in file_hashes.json
+        so that a large mzXML is only read once
+        """
+        hashes_file = os.path.join(self.cache_dir, 'file_hashes.json')
+        hashes = {}
+        if os.path.isfile(hashes_file):
+            try:
+                with open(hashes_file) as f:
+                    hashes = json.load(f)
+            except ValueError:
+                hashes = {}
+        stat = os.stat(filename)
+        path = os.path.abspath(filename)
+        signature = [stat.st_size, stat.st_mtime]
+        if path in hashes and hashes[path][0] == signature:
+            return hashes[path][1]
+
+        digest = file_hash(filename)
+        hashes[path] = [signature, digest]
+        temp_file = hashes_file + '.%d' %os.getpid()
+        with open(temp_file, 'w') as f:
+            json.dump(hashes, f)
+        os.replace(temp_file, hashes_file)
+        return digest
+
+    def stage_keys(self, filename, stage_params):
+        """
+        keys of the stages in STAGES order
+        stage_params maps a stage to a dict of its parameters
+        the key of a stage covers the keys of all stages before it
+        """
+        key = hashlib.sha1(json.dumps([CACHE_VERSION, self.input_hash(filename), code_hash()]).encode()).hexdigest()
+        keys = []
+        for stage in STAGES:
+            params = stage_params.get(stage, {})
+            key = hashlib.sha1(json.dumps([key, stage, params], sort_keys=True).encode()).hexdigest()
+            keys.append(key)
+        return keys
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        """
+        stage data stored under key or None
+        a hit marks the entry as recently used
+        """
+        filename = self.path(key)
+        if not os.path.isfile(filename):
+            return None
+        try:
+            stage_data = em.load_stage(filename)
+        except Exception as e:
+            print('could not read cache entry %s: %s' %(filename, e))
+            return None
+        os.utime(filename, None)
+        return stage_data
+
+    def save(self, stage_data, stage, key):
+        """
+        store stage data under key, written to a temporary file first so that parallel runs sharing
+        the cache never read a partial entry
+        """
+        filename = self.path(key)
+        temp_file = os.path.join(self.cache_dir, '%s.%d.tmp.npz' %(key, os.getpid()))
+        em.save_stage(stage_data, self.cache_dir, stage, filename=temp_file)
+        os.replace(temp_file, filename)
+        self.evict()
+        return filename
+
+    def resume(self, keys):
+        """
+        latest cached stage of a run
+        returns the number of stages already done and the data of the last one (0, None on a miss)
+        """
+        for i in range(len(keys), 0, -1):
+            stage_data = self.load(keys[i - 1])
+            if stage_data is not None:
+                print('resuming from cached %s stage' %STAGES[i - 1])
+                return i, stage_data
+        return 0, None
+
+    def evict(self):
+        """
+        remove the least recently used entries until the cache fits in size_limit
+        """
+        if self.size_limit is None:
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+                filename = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError: #removed by another run
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        entries.sort()
+        total = sum(size for mtime, size, filename in entries)
+        for mtime, size, filename in entries:
+            if total <= self.size_limit:
+                break
+            try:
+                os.remove(filename)
+                print('evicted %s from the stage cache' %filename)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,32 @@
+import extract_mzxml as em
+import argparse
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='check search_MS2_matches against search_MS2_matches_naive')
+    parser.add_argument('data_file', help='mzXML file to search')
+    parser.add_argument('--rt_tol', type=float, default=0.10)
+    parser.add_argument('--mz_tol', type=float, default=0.01)
+    args = parser.parse_args()
+
+    data = em.read_data(args.data_file)
+    table = em.scan_table(data)
+    id_list_ms2 = [i for i in range(0, len(data)) if data[i].get('msLevel') == 2]
+
+    start_time = time.time()
+    naive_dict = em.search_MS2_matches_naive(data, id_list_ms2, rt_tol=args.rt_tol, mz_tol=args.mz_tol)
+    naive_time = time.time() - start_time
+
+    start_time = time.time()
+    match_index_dict = em.search_MS2_matches(table, id_list_ms2, rt_tol=args.rt_tol, mz_tol=args.mz_tol)
+    sorted_time = time.time() - start_time
+
+    print('naive search: %s seconds, sorted search: %s seconds' %(str(naive_time), str(sorted_time)))
+    if match_index_dict != naive_dict:
+        raise SystemExit('match_index_dict differs from search_MS2_matches_naive')
+    print('match_index_dict is identical for %s groups' %len(match_index_dict))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,27 +14,19 @@ process extractPairs {
     publishDir "$params.outdir/extracted_data", mode: 'copy'
 
     input:
-    set file_id, extension, file(inputFile) from Channel.fromPath( params.inputSpectra ).map { file -> tuple(file.baseName, file.extension, file) }
+    set file_id, extension, file(inputFile) from Channel.fromPath( params.inputSpectra ).map { file -> def name = file.name - ~/\.gz$/; tuple(name.take(name.lastIndexOf('.')), name.tokenize('.').last(), file) }
  
     output:
     file "*_outdir" into extracted_folder_ch
 
     script:
     
-    if( extension == 'mzML' )
-        """
-        export LC_ALL=C
-
-        $TOOL_FOLDER/msconvert "$inputFile" --outfile "${file_id}.mzXML" --mzXML
-
-        mkdir "${file_id}_outdir"
-        python $TOOL_FOLDER/main.py "${file_id}.mzXML" "${file_id}_outdir"
-        """
-    else if ( extension == 'mzXML' )
+    //mzML, mzXML and their .gz are read directly by extract_mzxml.read_data()
+    if( extension == 'mzML' || extension == 'mzXML' )
         """
         mkdir "${file_id}_outdir"
-        python $TOOL_FOLDER/main.py "$inputFile" "${file_id}_outdir"
-        rm "${file_id}.mzXML"
+        python $TOOL_FOLDER/main.py "$inputFile" "${file_id}_outdir" --metrics --quiet
+        rm "$inputFile"
         """
     else
         error "Invalid Extension"
@@ -47,6 +39,7 @@ process condensePairs {
     cache false
 
     memory '60 GB'
+    cpus 8
 
     publishDir "$params.outdir/stitched_data", mode: 'copy'
 
@@ -58,6 +51,6 @@ process condensePairs {
 
     script:
     """
-    python $TOOL_FOLDER/processing.py input_dir ready_array2.npz --name concat.hdf5
+    python $TOOL_FOLDER/processing.py input_dir ready_array2.npz --name concat.hdf5 --workers ${task.cpus}
     """
 }
\ No newline at end of file
@@ -2,13 +2,26 @@ from keras.layers import Input, Dense, Conv1D, MaxPooling1D, UpSampling1D
 from keras.layers.advanced_activations import LeakyReLU
 from keras.models import Model
 from keras import backend as K
-from keras.callbacks import TensorBoard
+from keras.callbacks import TensorBoard, Callback
 
 import tensorflow as tf
 import numpy as np
+import platform
+import resource
 import pickle
 import json
 import h5py
+import os
+import time
+import zlib
+import queue
+import threading
+import collections
+import concurrent.futures
+
+from spectra_hdf5 import CHUNK_BYTES, SparseDataset, PairedDataset, load_dataset, sparsify_peaks, peak_mz, create_csr, append_csr
+
+VERBOSE = True #per batch prints of the generators
 
 def session_config(allocation=1):
     gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=allocation)
@@ -17,6 +30,378 @@ def session_config(allocation=1):
     sess = tf.Session(config=config)
     K.set_session(sess)
 
+class RebinnedDataset(object):
+    """
+    read-only view that sums every factor adjacent bins of a dataset while a batch is read
+    wraps h5py datasets, memmaps and SparseDataset of shape (n, width) or (n, width, 1)
+    lets data extracted at 0.01 Da train models at 0.1 Da (factor 10) or 1 Da (factor 100) without re-extraction
+    """
+    def __init__(self, X_data, factor):
+        width = X_data.shape[1]
+        if width % factor != 0:
+            raise ValueError('width %s is not divisible by the rebinning factor %s' %(width, factor))
+        self.X_data = X_data
+        self.factor = int(factor)
+        self.shape = (X_data.shape[0], width // self.factor) + tuple(X_data.shape[2:])
+        self.dtype = np.dtype(np.float32)
+        chunks = getattr(X_data, 'chunks', None)
+        self.chunks = (chunks[0],) + self.shape[1:] if chunks else None
+        self.attrs = dict((key, value) for key, value in getattr(X_data, 'attrs', {}).items() if key != 'shape')
+        if 'bins' in self.attrs:
+            self.attrs['bins'] = int(self.attrs['bins']) // self.factor
+            self.attrs['bin_width'] = float(self.attrs['bin_width']) * self.factor
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(self.X_data, SparseDataset) and isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if step != 1:
+                raise IndexError('RebinnedDataset only supports contiguous slices of a SparseDataset')
+            stop = max(start, stop)
+            indptr, indices, data = self.X_data.csr_rows(start, stop)
+            rows = np.repeat(np.arange(stop - start), np.diff(indptr))
+            #sum the stored values straight into the coarse bins
+            batch = np.bincount(rows * self.shape[1] + indices // self.factor, weights=data,
+                                minlength=(stop - start) * self.shape[1])
+            return batch.reshape((stop - start, self.shape[1])).astype(self.dtype)
+
+        batch = np.asarray(self.X_data[key], dtype=self.dtype)
+        axis = 0 if batch.ndim == len(self.shape) - 1 else 1 #a single row has no row axis
+        batch = batch.reshape(batch.shape[:axis] + (self.shape[1], self.factor) + batch.shape[axis + 1:])
+        return batch.sum(axis=axis + 1)
+
+def input_size(X_data):
+    """
+    number of bins of the data, read from the binning attributes written by concat_hdf5
+    falls back to the width of the data
+    """
+    attrs = getattr(X_data, 'attrs', {})
+    if 'bins' in attrs:
+        return int(attrs['bins'])
+    return int(X_data.shape[1])
+
+def compile_memmap(data, cache_dir, dtype='float32', rows_per_copy=1000):
+    """
+    one-time conversion of a training hdf5 into uncompressed memmaps, so epochs skip gzip
+    writes low_peaks.dat and high_peaks.dat, each starting on a page boundary at offset 0
+    memmap.json records the file, shape and dtype of each dataset and the path, size and mtime of data
+    dtype='float16' halves the cache
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    source = source_signature(data)
+    sidecar = {}
+    with h5py.File(data, 'r') as f:
+        for name in ['low_peaks', 'high_peaks']:
+            dataset = load_dataset(f, name)
+            filename = name + '.dat'
+            cache = np.memmap(os.path.join(cache_dir, filename), dtype=dtype, mode='w+', shape=dataset.shape)
+            for start in range(0, dataset.shape[0], rows_per_copy):
+                stop = min(start + rows_per_copy, dataset.shape[0])
+                cache[start:stop] = dataset[start:stop]
+            cache.flush()
+            del cache
+            attrs = dict((key, float(value)) for key, value in getattr(dataset, 'attrs', {}).items() if key != 'shape')
+            sidecar[name] = {'file':filename, 'shape':list(dataset.shape), 'dtype':np.dtype(dtype).str, 'attrs':attrs,
+                             'source':source}
+            print('compiled %s %s into %s' %(name, str(dataset.shape), os.path.join(cache_dir, filename)))
+    with open(os.path.join(cache_dir, 'memmap.json'), 'w') as output:
+        json.dump(sidecar, output)
+
+def source_signature(data):
+    """
+    path, size and mtime of a training hdf5, recorded by compile_memmap()
+    """
+    stat = os.stat(data)
+    return {'path':os.path.abspath(data), 'size':stat.st_size, 'mtime':stat.st_mtime}
+
+def memmap_current(cache_dir, data, dtype=None):
+    """
+    True when cache_dir holds memmaps compile_memmap() made from data as it is now
+    compares the path, size and mtime of data, the shape of every dataset and dtype when given
+    """
+    sidecar_file = os.path.join(cache_dir, 'memmap.json')
+    if not os.path.isfile(sidecar_file):
+        return False
+    with open(sidecar_file) as f:
+        sidecar = json.load(f)
+    source = source_signature(data)
+    with h5py.File(data, 'r') as f:
+        for name in ['low_peaks', 'high_peaks']:
+            info = sidecar.get(name)
+            if info is None or info.get('source') != source:
+                return False
+            if list(load_dataset(f, name).shape) != info['shape']:
+                return False
+            if dtype is not None and np.dtype(dtype).str != info['dtype']:
+                return False
+            if not os.path.isfile(os.path.join(cache_dir, info['file'])):
+                return False
+    return True
+
+def load_memmap(cache_dir, data=None):
+    """
+    open the memmaps written by compile_memmap() read only
+    with data given, raises ValueError unless they were compiled from data as it is now
+    returns dictionary of dataset name to np.memmap, slicing gives zero-copy views
+    """
+    if data is not None and not memmap_current(cache_dir, data):
+        raise ValueError('%s was not compiled from the current %s, run compile_memmap() again' %(cache_dir, data))
+    with open(os.path.join(cache_dir, 'memmap.json')) as f:
+        sidecar = json.load(f)
+    datasets = {}
+    for name, info in sidecar.items():
+        datasets[name] = np.memmap(os.path.join(cache_dir, info['file']), dtype=np.dtype(info['dtype']),
+                                    mode='r', shape=tuple(info['shape']))
+        datasets[name].attrs = info.get('attrs', {}) #binning for input_size()
+    return datasets
+
+def gzip_row_chunks(dataset):
+    """
+    True when every chunk of an h5py dataset is whole rows compressed by gzip alone
+    read_gzip_rows() can then decompress it outside h5py
+    """
+    if dataset.chunks is None or dataset.compression != 'gzip' or not hasattr(dataset.id, 'read_direct_chunk'):
+        return False
+    if dataset.id.get_create_plist().get_nfilters() != 1: #shuffle, fletcher32 or scaleoffset as well
+        return False
+    return tuple(dataset.chunks[1:]) == tuple(dataset.shape[1:])
+
+def read_gzip_rows(dataset, start, stop, out):
+    """
+    read rows start:stop of a dataset accepted by gzip_row_chunks() into out
+    h5py only hands over the compressed chunks, zlib releases the GIL while inflating them,
+    so BatchLoader threads decompress in parallel where h5py would serialize them behind its lock
+    """
+    chunk_rows = dataset.chunks[0]
+    zeros = (0,) * (len(dataset.shape) - 1)
+    chunk_bytes = int(np.prod(dataset.chunks)) * dataset.dtype.itemsize
+    for chunk_start in range(start - start % chunk_rows, stop, chunk_rows):
+        first = max(start, chunk_start)
+        last = min(stop, chunk_start + chunk_rows)
+        try:
+            filter_mask, raw = dataset.id.read_direct_chunk((chunk_start,) + zeros)
+        except RuntimeError: #chunk never written, h5py returns the fill value
+            dataset.read_direct(out, source_sel=np.s_[first:last], dest_sel=np.s_[first - start:last - start])
+            continue
+        if not filter_mask & 1: #bit set when gzip was skipped for this chunk
+            raw = zlib.decompress(raw, zlib.MAX_WBITS, chunk_bytes) #sized once, not grown while inflating
+        chunk = np.frombuffer(raw, dtype=dataset.dtype).reshape((chunk_rows,) + tuple(dataset.chunks[1:]))
+        out[first - start:last - start] = chunk[first - chunk_start:last - chunk_start]
+
+class BatchLoader(object):
+    """
+    iterates (X_batch, y_batch), or X_batch without y_data, like generator() and test_generator()
+    a thread pool reads the next batches into a ring of preallocated float32 buffers up to queue_size ahead
+    with more than one worker, gzip datasets of whole-row chunks are decompressed by the pool threads in parallel (read_gzip_rows())
+    a yielded batch stays valid while the consumer takes the next hold batches, keras queues up to max_queue_size + 2
+    wait_time is the time the consumer blocked on reading, compute_time the time spent between batches
+    """
+    def __init__(self, X_data, y_data=None, batch_size=10, workers=2, queue_size=4, hold=4, drop_last=True):
+        self.X_data = X_data
+        self.y_data = y_data
+        self.batch_size = batch_size
+        self.rows = X_data.shape[0]
+        if drop_last:
+            self.steps = self.rows // batch_size
+        else:
+            self.steps = -(-self.rows // batch_size)
+        if self.steps == 0:
+            raise ValueError('%s rows do not fill a batch of %s' %(self.rows, batch_size))
+        self.hold = hold
+        #chunks across batch boundaries are inflated by both batches, so a single thread is left to the hdf5 chunk cache
+        self.direct = [workers > 1 and isinstance(data, h5py.Dataset) and gzip_row_chunks(data) for data in [X_data, y_data]]
+        self.wait_time = 0.0
+        self.compute_time = 0.0
+        self.batches = 0
+
+        self.buffers = []
+        for i in range(0, queue_size + hold + 2):
+            X_buffer = np.empty((batch_size,) + tuple(X_data.shape[1:]), dtype=np.float32)
+            y_buffer = None
+            if y_data is not None:
+                y_buffer = np.empty((batch_size,) + tuple(y_data.shape[1:]), dtype=np.float32)
+            self.buffers.append((X_buffer, y_buffer))
+        self.free = queue.Queue()
+        for i in range(0, len(self.buffers)):
+            self.free.put(i)
+        self.ready = queue.Queue(maxsize=queue_size)
+        self.held = collections.deque()
+
+        self.stop = threading.Event()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.producer = threading.Thread(target=self._produce)
+        self.producer.daemon = True
+        self.producer.start()
+        self.last_time = None
+
+    def _read(self, data, start, stop, buffer, direct=False):
+        if direct:
+            read_gzip_rows(data, start, stop, buffer)
+        elif isinstance(data, h5py.Dataset):
+            data.read_direct(buffer, source_sel=np.s_[start:stop], dest_sel=np.s_[0:stop - start])
+        else:
+            buffer[:stop - start] = data[start:stop]
+
+    def _load(self, step, i):
+        start = step * self.batch_size
+        stop = min(start + self.batch_size, self.rows)
+        X_buffer, y_buffer = self.buffers[i]
+        self._read(self.X_data, start, stop, X_buffer, self.direct[0])
+        if y_buffer is not None:
+            self._read(self.y_data, start, stop, y_buffer, self.direct[1])
+        return i, stop - start
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        step = 0
+        while not self.stop.is_set():
+            try:
+                i = self.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if not self._put(self.ready, self.pool.submit(self._load, step, i)):
+                return
+            step = (step + 1) % self.steps
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        now = time.time()
+        if self.last_time is not None:
+            self.compute_time += now - self.last_time
+        i, rows = self.ready.get().result()
+        self.held.append(i)
+        if len(self.held) > self.hold:
+            self.free.put(self.held.popleft())
+        self.last_time = time.time()
+        self.wait_time += self.last_time - now
+        self.batches += 1
+
+        X_buffer, y_buffer = self.buffers[i]
+        if y_buffer is None:
+            return X_buffer[:rows]
+        return X_buffer[:rows], y_buffer[:rows]
+
+    next = __next__
+
+    def close(self):
+        self.stop.set()
+        self.producer.join()
+        self.pool.shutdown(wait=True)
+
+    def report(self):
+        """
+        print how long the consumer waited on I/O versus computed
+        """
+        total = self.wait_time + self.compute_time
+        print('%s batches: %.2f seconds waiting on I/O, %.2f seconds computing (%.1f%% waiting)'
+                %(self.batches, self.wait_time, self.compute_time, 100.0 * self.wait_time / total if total > 0 else 0.0))
+
+def close_loaders(*batches):
+    """
+    stop the threads of every BatchLoader among batches and report their waits
+    """
+    for batch_source in batches:
+        if isinstance(batch_source, BatchLoader):
+            batch_source.close()
+            batch_source.report()
+
+class TimedBatches(object):
+    """
+    wraps a generator and adds up the time its consumer blocked on reading, like BatchLoader.wait_time
+    """
+    def __init__(self, batches):
+        self.batches = batches
+        self.wait_time = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        now = time.time()
+        batch = next(self.batches)
+        self.wait_time += time.time() - now
+        return batch
+
+    next = __next__
+
+def timed_batches(batches):
+    """
+    BatchLoader keeps its own wait_time, other generators are wrapped in TimedBatches
+    """
+    if isinstance(batches, (BatchLoader, TimedBatches)):
+        return batches
+    return TimedBatches(batches)
+
+def peak_rss_mb():
+    """
+    peak resident memory of this process in MB (ru_maxrss is in kilobytes on linux, bytes on macOS)
+    same as bin/metrics.peak_rss_mb(), which is not importable from here
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        return peak / 1024.0 / 1024.0
+    return peak / 1024.0
+
+class ThroughputCallback(Callback):
+    """
+    records the training throughput of every epoch into the epoch logs, so that model.history and save_history() keep it
+    samples_per_second: training samples over the time from the start of the epoch to its last batch
+    step_time, step_time_max: mean and slowest seconds of train_on_batch
+    queue_wait: seconds the training loop waited for the next batch from the keras queue
+    read_time: seconds the generator spent reading batches (from BatchLoader or TimedBatches)
+    peak_rss_mb: peak host memory of the process
+    a large queue_wait means training is I/O-bound, a queue_wait near 0 that it is compute-bound
+    """
+    def __init__(self, batches=None):
+        super(ThroughputCallback, self).__init__()
+        self.batches = batches
+        self.step_times = [] #seconds of every batch of the last epoch
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+        self.last_end = self.epoch_start
+        self.step_times = []
+        self.queue_wait = 0.0
+        self.samples = 0
+        self.read_start = getattr(self.batches, 'wait_time', 0.0)
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_start = time.time()
+        self.queue_wait += self.batch_start - self.last_end
+
+    def on_batch_end(self, batch, logs=None):
+        self.last_end = time.time()
+        self.step_times.append(self.last_end - self.batch_start)
+        self.samples += (logs or {}).get('size', 0)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None or not self.step_times:
+            return
+        seconds = self.last_end - self.epoch_start
+        logs['samples_per_second'] = self.samples / seconds if seconds > 0 else 0.0
+        logs['step_time'] = float(np.mean(self.step_times))
+        logs['step_time_max'] = float(np.max(self.step_times))
+        logs['queue_wait'] = self.queue_wait
+        if hasattr(self.batches, 'wait_time'):
+            logs['read_time'] = self.batches.wait_time - self.read_start
+        logs['peak_rss_mb'] = peak_rss_mb()
+        print('epoch %s: %.1f samples/s, %.4f s per step, %.2f s of %.2f s waiting on the queue (%.1f%%), %.1f MB peak'
+                %(epoch + 1, logs['samples_per_second'], logs['step_time'], self.queue_wait, seconds,
+                  100.0 * self.queue_wait / seconds if seconds > 0 else 0.0, logs['peak_rss_mb']))
+
 def generator(X_data, y_data, batch_size):
     print('generator initiated')
     steps_per_epoch = X_data.shape[0]
@@ -28,7 +413,8 @@ def generator(X_data, y_data, batch_size):
         y_batch = y_data[i*batch_size:(i+1)*batch_size]
         i += 1
         yield X_batch, y_batch
-        print('\ngenerator yielded a batch %s' %i)
+        if VERBOSE:
+            print('\ngenerator yielded a batch %s' %i)
         
         if i >= number_of_batches:
             i = 0
@@ -44,7 +430,8 @@ def training_generator(X_data, y_data, batch_size):
         y_batch = y_data[i*batch_size:(i+1)*batch_size]
         i += 1
         yield X_batch, y_batch
-        print('\ntraining generator yielded a batch %s' %i)
+        if VERBOSE:
+            print('\ntraining generator yielded a batch %s' %i)
         
         if i >= number_of_batches:
             i = 0
@@ -59,44 +446,113 @@ def validation_generator(X_data, y_data, batch_size):
         y_batch = y_data[i*batch_size:(i+1)*batch_size]
         i += 1
         yield X_batch, y_batch
-        print('\nvalidation generator yielded a batch %s' %i)
+        if VERBOSE:
+            print('\nvalidation generator yielded a batch %s' %i)
 
         if i >= number_of_batches:
             i = 0
 
+def shuffled_generator(X_data, y_data, batch_size, buffer_chunks=8, seed=None):
+    """
+    near random batches that still read the data sequentially
+    the order of hdf5 chunks is shuffled every epoch, buffer_chunks chunks are read at a time and their rows shuffled in memory
+    datasets without chunks are read in blocks of batch_size rows
+    yields X_batch without y_data
+    """
+    print('shuffled generator initiated')
+    rng = np.random.RandomState(seed)
+    rows = X_data.shape[0]
+    chunks = getattr(X_data, 'chunks', None)
+    chunk_rows = chunks[0] if chunks else batch_size
+    chunk_starts = np.arange(0, rows, chunk_rows)
+
+    while True:
+        rng.shuffle(chunk_starts)
+        X_carry = X_data[0:0]
+        y_carry = y_data[0:0] if y_data is not None else None
+        for i in range(0, len(chunk_starts), buffer_chunks):
+            starts = np.sort(chunk_starts[i:i + buffer_chunks]) #read the buffered chunks in file order
+            X_buffer = np.concatenate([X_carry] + [X_data[start:start + chunk_rows] for start in starts], axis=0)
+            order = rng.permutation(len(X_buffer))
+            X_buffer = X_buffer[order]
+            if y_data is not None:
+                y_buffer = np.concatenate([y_carry] + [y_data[start:start + chunk_rows] for start in starts], axis=0)
+                y_buffer = y_buffer[order]
+
+            full = len(X_buffer) - len(X_buffer) % batch_size
+            for start in range(0, full, batch_size):
+                if y_data is None:
+                    yield X_buffer[start:start + batch_size]
+                else:
+                    yield X_buffer[start:start + batch_size], y_buffer[start:start + batch_size]
+            X_carry = X_buffer[full:] #rows short of a batch move to the next buffer
+            if y_data is not None:
+                y_carry = y_buffer[full:]
+
 def test_generator(X_data, batch_size):
+    """
+    yields every row once per pass, the last batch of a pass holds the remaining rows
+    """
     print('generator initiated')
     steps_per_epoch = X_data.shape[0]
-    number_of_batches = steps_per_epoch // batch_size
+    number_of_batches = -(-steps_per_epoch // batch_size)
     i = 0
 
     while True: 
         X_batch = X_data[i*batch_size:(i+1)*batch_size]
         i += 1
         yield X_batch
-        print('\ngenerator yielded a batch %s' %i)
+        if VERBOSE:
+            print('\ngenerator yielded a batch %s' %i)
 
         if i >= number_of_batches:
             i = 0
 
-def fit_model(model, X_data, y_data):
+def fit_model(model, X_data, y_data, prefetch=0, shuffle=False, seed=None):
+    """
+    prefetch > 0 reads batches with a BatchLoader of that many threads
+    shuffle=True samples batches with shuffled_generator() instead, prefetch is then left to keras' own queue
+    """
     batch_size = 10
-    model.fit_generator(generator=generator(X_data, y_data, batch_size),
-                        max_queue_size=40, 
-                        steps_per_epoch=X_data.shape[0] // batch_size, 
-                        epochs=1,
-                        callbacks=[TensorBoard(log_dir='/tmp/autoencoder')])
+    max_queue_size = 40
+    batches = generator(X_data, y_data, batch_size)
+    if shuffle:
+        batches = shuffled_generator(X_data, y_data, batch_size, seed=seed)
+    elif prefetch:
+        max_queue_size = 2
+        batches = BatchLoader(X_data, y_data, batch_size, workers=prefetch, hold=max_queue_size + 2)
+    batches = timed_batches(batches)
+    try:
+        model.fit_generator(generator=batches,
+                            max_queue_size=max_queue_size, 
+                            steps_per_epoch=X_data.shape[0] // batch_size, 
+                            epochs=1,
+                            callbacks=[TensorBoard(log_dir='/tmp/autoencoder'), ThroughputCallback(batches)])
+    finally:
+        close_loaders(batches)
     return model
 
-def fit_val_model(model, X_data, y_data, X_val, y_val):
+def fit_val_model(model, X_data, y_data, X_val, y_val, prefetch=0):
     batch_size = 10000
     batch_size_val = 1000
-    model.fit_generator(generator=generator(X_data, y_data, batch_size),
-                        validation_data=validation_generator(X_val, y_val, batch_size_val),
-                        validation_steps=X_val.shape[0],
-                        steps_per_epoch=X_data.shape[0] // batch_size,
-                        max_queue_size=40,
-                        epochs=1)
+    max_queue_size = 40
+    batches = generator(X_data, y_data, batch_size)
+    val_batches = validation_generator(X_val, y_val, batch_size_val)
+    if prefetch:
+        max_queue_size = 2
+        batches = BatchLoader(X_data, y_data, batch_size, workers=prefetch, hold=max_queue_size + 2)
+        val_batches = BatchLoader(X_val, y_val, batch_size_val, workers=prefetch, hold=max_queue_size + 2)
+    batches = timed_batches(batches)
+    try:
+        model.fit_generator(generator=batches,
+                            validation_data=val_batches,
+                            validation_steps=X_val.shape[0],
+                            steps_per_epoch=X_data.shape[0] // batch_size,
+                            max_queue_size=max_queue_size,
+                            epochs=1,
+                            callbacks=[ThroughputCallback(batches)])
+    finally:
+        close_loaders(batches, val_batches)
     return model
 
 def fit_val_model2(model, X_data, y_data):
@@ -105,26 +561,118 @@ def fit_val_model2(model, X_data, y_data):
     train_len = int(split * len(X_data))
     val_len = int((1 - split) * len(X_data))
 
-    model.fit_generator(generator=generator(X_data[:train_len], y_data[:train_len], batch_size),
+    batches = timed_batches(generator(X_data[:train_len], y_data[:train_len], batch_size))
+    model.fit_generator(generator=batches,
                         validation_data=validation_generator(X_data[train_len:], y_data[train_len:], batch_size),
                         validation_steps=val_len,
                         steps_per_epoch=train_len // batch_size,
                         max_queue_size=40,
-                        epochs=1)
+                        epochs=1,
+                        callbacks=[ThroughputCallback(batches)])
     return model
 
-def predict_model(model, X_data):
+def predict_model(model, X_data, prefetch=0):
+    """
+    predictions of every row in memory, the last batch may be partial
+    predict_to_file() streams them to disk instead
+    """
     batch_size = 100
-    prediction = model.predict_generator(generator=test_generator(X_data, batch_size),
-                                            max_queue_size=10,
-                                            steps=X_data.shape[0] // batch_size)
+    max_queue_size = 10
+    batches = test_generator(X_data, batch_size)
+    if prefetch:
+        max_queue_size = 2
+        batches = BatchLoader(X_data, None, batch_size, workers=prefetch, hold=max_queue_size + 2, drop_last=False)
+    try:
+        prediction = model.predict_generator(generator=batches,
+                                                max_queue_size=max_queue_size,
+                                                steps=-(-X_data.shape[0] // batch_size))
+    finally:
+        close_loaders(batches)
+    if len(prediction) != X_data.shape[0]:
+        raise ValueError('%s predictions for %s rows' %(len(prediction), X_data.shape[0]))
     return prediction
 
-def eval_model(model, X_data, y_data):
+def predict_to_file(model, X_data, filename, batch_size=100, prefetch=2, name='predictions', report_every=100,
+                    top_k=None, threshold=None):
+    """
+    predicts every row of X_data one batch at a time and writes the batches straight into filename
+    filename ending in .npy is written as a memmap, anything else as dataset name of a new hdf5 file
+    with the binning attributes of X_data, so memory holds only the batches in flight
+    hdf5 chunks hold at most CHUNK_BYTES whatever the batch size
+    top_k or threshold keep only those peaks of every prediction (sparsify_peaks()) and store name as a CSR group
+    prefetch > 0 reads ahead with a BatchLoader of that many threads
+    returns rows, seconds and rows_per_second (and peaks when sparse)
+    """
+    rows = X_data.shape[0]
+    shape = (rows,) + tuple(model.output_shape[1:])
+    attrs = dict((key, value) for key, value in getattr(X_data, 'attrs', {}).items() if key != 'shape')
+    sparse = bool(top_k or threshold)
+    f = None
+    if filename.endswith('.npy'):
+        if sparse:
+            raise ValueError('sparse predictions are written to hdf5, not %s' %filename)
+        output = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=shape)
+    else:
+        f = h5py.File(filename, 'w')
+        if sparse:
+            output = create_csr(f, name, int(np.prod(shape[1:])), attrs)
+        else:
+            chunk_rows = max(1, min(batch_size, rows, CHUNK_BYTES // (4 * int(np.prod(shape[1:]))))) #as concat_hdf5.PeaksWriter
+            output = f.create_dataset(name, shape=shape, dtype=np.float32,
+                                      chunks=(chunk_rows,) + shape[1:], compression='gzip')
+            output.attrs.update(attrs)
+
+    loader = None
+    if prefetch:
+        loader = BatchLoader(X_data, None, batch_size, workers=prefetch, hold=1, drop_last=False)
+    start_time = time.time()
+    try:
+        steps = -(-rows // batch_size)
+        for step in range(0, steps):
+            start = step * batch_size
+            stop = min(start + batch_size, rows)
+            if loader is not None:
+                X_batch = next(loader)
+            else:
+                X_batch = np.asarray(X_data[start:stop], dtype=np.float32)
+            if sparse:
+                append_csr(output, *sparsify_peaks(model.predict_on_batch(X_batch), top_k, threshold))
+            else:
+                output[start:stop] = model.predict_on_batch(X_batch)
+            if report_every and (step + 1) % report_every == 0:
+                print('predicted %s of %s rows, %.1f rows/s' %(stop, rows, stop / (time.time() - start_time)))
+        if sparse:
+            peaks = int(output['indptr'][-1])
+    finally:
+        if loader is not None:
+            close_loaders(loader)
+        if f is not None:
+            f.close()
+        else:
+            output.flush()
+            del output
+
+    seconds = time.time() - start_time
+    throughput = {'rows':rows, 'seconds':seconds, 'rows_per_second':rows / seconds if seconds > 0 else 0.0}
+    if sparse:
+        throughput['peaks'] = peaks
+        print('kept %s peaks, %.1f per spectrum' %(peaks, peaks / float(max(rows, 1))))
+    print('predicted %(rows)s rows in %(seconds).1f seconds, %(rows_per_second).1f rows/s' %throughput)
+    return throughput
+
+def eval_model(model, X_data, y_data, prefetch=0):
     batch_size = 10000
-    evaluation = model.evaluate_generator(generator=generator(X_data, y_data, batch_size),
-                                            max_queue_size=40,
-                                            steps=X_data.shape[0] // batch_size)
+    max_queue_size = 40
+    batches = generator(X_data, y_data, batch_size)
+    if prefetch:
+        max_queue_size = 2
+        batches = BatchLoader(X_data, y_data, batch_size, workers=prefetch, hold=max_queue_size + 2)
+    try:
+        evaluation = model.evaluate_generator(generator=batches,
+                                                max_queue_size=max_queue_size,
+                                                steps=X_data.shape[0] // batch_size)
+    finally:
+        close_loaders(batches)
     return evaluation
 
 def save_model(model, name_h5):
@@ -132,6 +680,9 @@ def save_model(model, name_h5):
     print('model has been saved to .h5')
 
 def save_history(history, filename):
+    """
+    pickles history.history, with the ThroughputCallback numbers of every epoch
+    """
     with open(filename, 'wb') as file_pi:
         pickle.dump(history.history, file_pi)
     print('training history has been saved to %s' %filename)
@@ -141,8 +692,12 @@ def load_history(history_file):
     history_dict = pickle.load(file)
     return history_dict
 
-def model_Conv1D():
-    input_size = 2000
+def model_Conv1D(input_size=2000):
+    """
+    input_size is the number of bins, see input_size(), and must be a multiple of 20 for the pooling
+    """
+    if input_size % 20 != 0:
+        raise ValueError('model_Conv1D needs an input_size divisible by 20, got %s' %input_size)
     input_scan = Input(shape=(input_size, 1))
     print(input_scan.shape)
     hidden_1 = Conv1D(1, (5, ), activation='relu', padding='same')(input_scan)
@@ -172,8 +727,7 @@ def model_Conv1D():
     model.compile(optimizer='adadelta', loss='cosine_proximity', metrics=['accuracy'])
     return model
 
-def model_deep_autoencoder():
-    input_size = 2000
+def model_deep_autoencoder(input_size=2000):
     encoding_dim = 100
     input_scan = Input(shape=(input_size,))
     hidden_1 = Dense(1000, activation='relu')(input_scan)
@@ -188,8 +742,7 @@ def model_deep_autoencoder():
     autoencoder.compile(optimizer='adadelta', loss='cosine_proximity', metrics=['accuracy'])
     return autoencoder
 
-def model_autoencoder():
-    input_size = 2000
+def model_autoencoder(input_size=2000):
     encoding_dim = 2000
     input_scan = Input(shape=(input_size,))
     encoded = Dense(encoding_dim, activation='relu')(input_scan)
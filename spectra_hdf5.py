@@ -0,0 +1,171 @@
+import numpy as np
+import h5py
+
+CHUNK_BYTES = 2 * 1024 * 1024 #upper bound of one gzip chunk of the dense datasets written by concat_hdf5 and ms2_model
+
+class SparseDataset(object):
+    """
+    read-only view of a CSR group written by concat_hdf5.stitch_hdf5_sparse()
+    slicing returns dense float32 rows so the generators densify one batch at a time
+    """
+    def __init__(self, group):
+        self.group = group
+        self.indptr = group['indptr'][:]
+        self.shape = tuple(int(n) for n in group.attrs['shape'])
+        self.attrs = dict(group.attrs)
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def csr_rows(self, start, stop):
+        """
+        indptr, indices and data of rows start:stop
+        """
+        indptr = self.indptr[start:stop + 1]
+        indices = self.group['indices'][indptr[0]:indptr[-1]]
+        data = self.group['data'][indptr[0]:indptr[-1]]
+        return indptr - indptr[0], indices, data
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if step != 1:
+                raise IndexError('SparseDataset only supports contiguous slices')
+        else:
+            start = int(key)
+            if start < 0:
+                start += self.shape[0]
+            if not 0 <= start < self.shape[0]:
+                raise IndexError('index %s is out of range for %s rows' %(key, self.shape[0]))
+            stop = start + 1
+        stop = max(start, stop)
+        indptr, indices, data = self.csr_rows(start, stop)
+
+        batch = np.zeros((stop - start, self.shape[1]), dtype=self.dtype)
+        rows = np.repeat(np.arange(stop - start), np.diff(indptr))
+        batch[rows, indices] = data
+        if not isinstance(key, slice):
+            return batch[0]
+        return batch
+
+    def take(self, rows):
+        """
+        dense float32 rows in the order given, rows may repeat
+        rows close together in the file are read in one span, scattered rows one at a time
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return np.zeros((0, self.shape[1]), dtype=self.dtype)
+        unique, inverse = np.unique(rows, return_inverse=True)
+        batch = np.zeros((len(unique), self.shape[1]), dtype=self.dtype)
+        lengths = self.indptr[unique + 1] - self.indptr[unique]
+        span = self.indptr[unique[-1] + 1] - self.indptr[unique[0]]
+        if span <= 4 * lengths.sum() + 65536:
+            indptr, indices, data = self.csr_rows(int(unique[0]), int(unique[-1]) + 1)
+            offset = unique[0]
+        else:
+            indptr, indices, data = None, None, None
+        for i, row in enumerate(unique):
+            if indptr is not None:
+                start, stop = indptr[row - offset], indptr[row - offset + 1]
+                batch[i, indices[start:stop]] = data[start:stop]
+            else:
+                row_indices, row_data = self.csr_rows(int(row), int(row) + 1)[1:]
+                batch[i, row_indices] = row_data
+        return batch[inverse]
+
+class PairedDataset(object):
+    """
+    read-only view of the low (side 0) or high (side 1) spectra of a pair-by-reference file from concat_hdf5.stitch_hdf5_pairs()
+    row i is the spectrum of pair i, gathered from the spectra table while a batch is read
+    training sees the same rows as from a file that stores every pair
+    """
+    def __init__(self, f, side):
+        self.spectra = SparseDataset(f['spectra'])
+        self.rows = f['pairs'][:, side]
+        self.shape = (len(self.rows), self.spectra.shape[1])
+        self.dtype = self.spectra.dtype
+        self.chunks = None
+        self.attrs = dict((key, value) for key, value in self.spectra.attrs.items() if key != 'shape')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.spectra.take(self.rows[key])
+        return self.spectra.take([self.rows[int(key)]])[0]
+
+def load_dataset(f, name):
+    """
+    open dataset name from an h5py file
+    low_peaks and high_peaks of a pair-by-reference file are wrapped in PairedDataset,
+    CSR groups in SparseDataset, dense datasets are returned as they are
+    """
+    if name in ['low_peaks', 'high_peaks'] and name not in f and 'pairs' in f:
+        return PairedDataset(f, 0 if name == 'low_peaks' else 1)
+    if isinstance(f[name], h5py.Group):
+        return SparseDataset(f[name])
+    return f[name]
+
+def sparsify_peaks(batch, top_k=None, threshold=None):
+    """
+    CSR arrays (indptr, indices, data) of the peaks kept from a batch of predicted spectra
+    keeps positive bins, only the top_k most intense of each row and/or those above threshold times the row maximum
+    indices are bins in m/z order, peak_mz() turns them into m/z
+    """
+    batch = np.asarray(batch, dtype=np.float32).reshape(len(batch), -1)
+    width = batch.shape[1]
+    keep = batch > 0
+    if threshold:
+        keep &= batch >= threshold * batch.max(axis=1, keepdims=True)
+    if top_k and top_k < width:
+        top = np.argpartition(batch, width - top_k, axis=1)[:, width - top_k:] #unordered top_k bins of every row
+        in_top = np.zeros(batch.shape, dtype=bool)
+        np.put_along_axis(in_top, top, True, axis=1)
+        keep &= in_top
+    rows, indices = np.nonzero(keep)
+    indptr = np.zeros(len(batch) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(batch)), out=indptr[1:])
+    return indptr, indices.astype(np.int32), batch[rows, indices]
+
+def peak_mz(indices, attrs):
+    """
+    m/z of bins, the left edge of each bin of the binning attributes (0-2000 in 0.01 Da bins when missing)
+    """
+    mz_min = float(attrs.get('mz_min', 0.0))
+    bin_width = float(attrs.get('bin_width', 0.01))
+    return mz_min + np.asarray(indices, dtype=np.float64) * bin_width
+
+def create_csr(f, name, width=0, attrs=None):
+    """
+    empty CSR group of indptr, indices and data, the layout of concat_hdf5 and ms2_model.predict_to_file()
+    read back by SparseDataset
+    """
+    group = f.create_group(name)
+    group.create_dataset('indptr', data=np.zeros(1, dtype=np.int64), maxshape=(None,), chunks=True)
+    group.create_dataset('indices', shape=(0,), maxshape=(None,), dtype=np.int32, chunks=True, compression='gzip')
+    group.create_dataset('data', shape=(0,), maxshape=(None,), dtype=np.float32, chunks=True, compression='gzip')
+    group.attrs.update(attrs or {})
+    group.attrs['shape'] = (0, width)
+    return group
+
+def append_csr(group, indptr, indices, data, width=None):
+    """
+    append the rows of CSR arrays (or of a scipy.sparse.csr_matrix's indptr, indices and data) to a group from create_csr()
+    width sets the shape of a group created before the width was known
+    returns the number of rows before the append, the row offset of the appended rows
+    """
+    nnz_prev = group['indices'].shape[0]
+    rows_prev = group['indptr'].shape[0] - 1
+    group['indptr'].resize((rows_prev + len(indptr),))
+    group['indptr'][rows_prev + 1:] = np.asarray(indptr[1:], dtype=np.int64) + nnz_prev
+    group['indices'].resize((nnz_prev + len(indices),))
+    group['indices'][nnz_prev:] = indices
+    group['data'].resize((nnz_prev + len(data),))
+    group['data'][nnz_prev:] = data
+    if width is None:
+        width = group.attrs['shape'][1]
+    group.attrs['shape'] = (rows_prev + len(indptr) - 1, width)
+    return rows_prev
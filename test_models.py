@@ -6,27 +6,36 @@ import argparse
 
 from tensorflow.keras.models import load_model
 
-parser = argparse.ArgumentParser()
+parser = argparse.ArgumentParser(description='predict every row of a dataset with a saved model, streaming the predictions to disk')
 parser.add_argument('data', help='testing data in relative path')
 parser.add_argument('model', help='select the saved model being tested and evaluated in relative path')
+parser.add_argument('--dataset', default='high_peaks', help='dataset of the data file to predict')
+parser.add_argument('--output', default='predictions.hdf5', help='predictions file in relative path, .hdf5 or .npy (memmap)')
+parser.add_argument('--batch_size', type=int, default=100, help='rows predicted at a time')
+parser.add_argument('--prefetch', type=int, default=2, help='threads reading batches ahead of prediction, 0 reads in the main thread')
+parser.add_argument('--top_k', type=int, default=None, help='keep only the k most intense peaks of every prediction, stored sparse')
+parser.add_argument('--threshold', type=float, default=None, help='keep only peaks above this fraction of the most intense peak, stored sparse')
+parser.add_argument('--rebin', type=int, default=1, help='sum this many adjacent bins while reading, as the model was trained')
+parser.add_argument('--evaluate', action='store_true', help='also evaluate the model on the dataset against itself')
 
 args = parser.parse_args()
 
 dirname = os.path.dirname(os.path.realpath(__file__))
 data = os.path.join(dirname, args.data)
 model_path = os.path.join(dirname, args.model)
-
-#my line
-model_path = "./models_new/autoencoder/autoencoder.h5"
+save_path = os.path.join(dirname, args.output)
 
 model = load_model(model_path)
 
 f = h5py.File(data, 'r')
-dataset_low = f['low_peaks']
-dataset_high = f['high_peaks']
-
-prediction = ms2_model.predict_model(model, dataset_high)
-evaluation = ms2_model.eval_model(model, dataset_high, dataset_high)
-print('Testing accuracy: ', evaluation[1])
-save_path = os.path.join(dirname, 'predictions.npy')
-np.save(save_path, prediction)
+dataset = ms2_model.load_dataset(f, args.dataset)
+if args.rebin > 1:
+    dataset = ms2_model.RebinnedDataset(dataset, args.rebin)
+print(dataset.shape)
+
+ms2_model.predict_to_file(model, dataset, save_path, batch_size=args.batch_size, prefetch=args.prefetch,
+                          top_k=args.top_k, threshold=args.threshold)
+print('predictions have been saved to %s' %save_path)
+if args.evaluate:
+    evaluation = ms2_model.eval_model(model, dataset, dataset)
+    print('Testing accuracy: ', evaluation[1])
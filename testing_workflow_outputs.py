@@ -2,11 +2,19 @@ import numpy as np
 import copy
 import os
 import json
+import h5py
+import zipfile
 import argparse
+import scipy.sparse
 import pandas as pd
 import matplotlib.pyplot as plt
 from pyteomics import mgf
 
+import spectra_hdf5
+
+MGF_HEADER = 'BEGIN IONS\nFEATURE_ID=%d\nFILENAME=%s\nPEPMASS=%s\nSCANS=%d\nRTINSECONDS=%s\nCHARGE=1+\nMSLEVEL=2\nPRECURSORINTEN=%s\n'
+PEAK_FORMAT = '%.4f %.8g\n'
+
 ###fuction writes to a mgf file
 def write_mgf(spectra_list):
     mgf.write(spectra = spectra_list, output = "./GNPS2.mgf", write_charges = False, use_numpy = True)
@@ -50,71 +58,198 @@ def build_learning_curve(df):
     #plt.savefig('./leanring_curve_low_high.png')
     plt.show()
 
+###streams spectra to an mgf file a batch at a time, with the parameters of format_mgf()
+class MGFWriter(object):
+    '''
+    FEATURE_ID and SCANS count up from 1 over every spectrum written, so they follow the order of the input rows
+    peaks of a whole batch are formatted by one string operation per spectrum instead of a dictionary per spectrum
+    '''
+    def __init__(self, filename, feature_id=0):
+        self.filename = filename
+        self.file = open(filename, 'w')
+        self.feature_id = feature_id
+
+    def write_peaks(self, indptr, mz, intensity, pepmass, rt=None, precursor_intensity=None, filepath='None'):
+        '''
+        spectrum i of the batch has the peaks mz[indptr[i]:indptr[i + 1]], intensity[indptr[i]:indptr[i + 1]]
+        pepmass, rt (in minutes) and precursor_intensity give one value per spectrum, rt and precursor_intensity default to 0.0
+        '''
+        indptr = np.asarray(indptr, dtype=np.int64) - indptr[0]
+        count = len(indptr) - 1
+        pepmass = np.asarray(pepmass, dtype=np.float64).tolist()
+        rt = (np.zeros(count) if rt is None else np.asarray(rt, dtype=np.float64) * 60).tolist()
+        precursor_intensity = (np.zeros(count) if precursor_intensity is None else np.asarray(precursor_intensity, dtype=np.float64)).tolist()
+        peaks = np.empty(2 * indptr[-1], dtype=np.float64) #m/z and intensity interleaved
+        peaks[0::2] = mz
+        peaks[1::2] = intensity
+        peaks = peaks.tolist()
+
+        parts = []
+        for i in range(0, count):
+            start, stop = indptr[i], indptr[i + 1]
+            self.feature_id += 1
+            parts.append(MGF_HEADER %(self.feature_id, filepath, pepmass[i], self.feature_id, rt[i], precursor_intensity[i]))
+            parts.append(PEAK_FORMAT * (stop - start) %tuple(peaks[2 * start:2 * stop]))
+            parts.append('END IONS\n\n')
+        self.file.write(''.join(parts))
+
+    def write_binned(self, batch, attrs, pepmass, rt=None, precursor_intensity=None, filepath='None', top_k=None, threshold=None):
+        '''
+        write a batch of binned vectors, keeping the non-zero bins (or the top_k / threshold peaks, see spectra_hdf5.sparsify_peaks())
+        attrs holds the binning (mz_min, bin_width) that turns bins into m/z
+        '''
+        indptr, indices, intensity = spectra_hdf5.sparsify_peaks(batch, top_k, threshold)
+        self.write_peaks(indptr, spectra_hdf5.peak_mz(indices, attrs), intensity, pepmass, rt, precursor_intensity, filepath)
+
+    def close(self):
+        self.file.close()
+        print('wrote %s spectra to %s' %(self.feature_id, self.filename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+###precursor values of every row of a training/testing hdf5, empty for files without them
+def load_metadata(filename, side=1):
+    '''
+    pair-by-reference files from concat_hdf5.stitch_hdf5_pairs() store precursorMz, retentionTime and precursorIntensity per spectrum
+    row i is looked up through the low (side 0) or high (side 1) spectrum of pair i
+    '''
+    metadata = {}
+    with h5py.File(filename, 'r') as f:
+        if 'pairs' not in f:
+            return metadata
+        rows = f['pairs'][:, side]
+        for key in ['precursorMz', 'retentionTime', 'precursorIntensity']:
+            if key in f:
+                metadata[key] = f[key][:][rows]
+    return metadata
+
+###predictions (.npy, dense hdf5 dataset or sparse group of ms2_model.predict_to_file()) to mgf
+def export_predictions(filename, output, name='predictions', metadata_file=None, side=1, batch_size=1000, top_k=None, threshold=None):
+    '''
+    PEPMASS, RTINSECONDS and PRECURSORINTEN come from metadata_file, the hdf5 the predictions were made from, when it has them
+    sparse predictions are written from their CSR rows without densifying
+    '''
+    metadata = load_metadata(metadata_file, side) if metadata_file else {}
+    f = None
+    if filename.endswith('.npy'):
+        data = np.load(filename, mmap_mode='r')
+        attrs = {}
+        if metadata_file:
+            with h5py.File(metadata_file, 'r') as g:
+                attrs = dict(spectra_hdf5.load_dataset(g, 'high_peaks').attrs)
+    else:
+        f = h5py.File(filename, 'r')
+        data = spectra_hdf5.load_dataset(f, name)
+        attrs = dict(data.attrs)
+
+    rows = data.shape[0]
+    with MGFWriter(output) as writer:
+        for start in range(0, rows, batch_size):
+            stop = min(start + batch_size, rows)
+            pepmass = metadata['precursorMz'][start:stop] if 'precursorMz' in metadata else np.zeros(stop - start)
+            rt = metadata['retentionTime'][start:stop] if 'retentionTime' in metadata else None
+            precursor_intensity = metadata['precursorIntensity'][start:stop] if 'precursorIntensity' in metadata else None
+            if isinstance(data, spectra_hdf5.SparseDataset) and not (top_k or threshold):
+                indptr, indices, intensity = data.csr_rows(start, stop)
+                writer.write_peaks(indptr, spectra_hdf5.peak_mz(indices, attrs), intensity, pepmass, rt, precursor_intensity, filename)
+            else:
+                writer.write_binned(data[start:stop], attrs, pepmass, rt, precursor_intensity, filename, top_k, threshold)
+    if f is not None:
+        f.close()
+
+def npz_header(member):
+    '''
+    shape, fortran order and dtype from the header of an open .npy member, leaves it at the first row
+    '''
+    version = np.lib.format.read_magic(member)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(member)
+    return np.lib.format.read_array_header_2_0(member)
+
+def npz_shape(filename, name='arr_0'):
+    '''
+    shape of array name in a .npz, read from the .npy header only
+    '''
+    with zipfile.ZipFile(filename) as archive:
+        with archive.open(name + '.npy') as member:
+            return npz_header(member)[0]
+
+def npz_blocks(filename, batch_size=1000, name='arr_0'):
+    '''
+    generator of (start, block of up to batch_size rows) of array name in a .npz
+    rows are decompressed from the .npy member as they are read, the array is never loaded whole
+    '''
+    with zipfile.ZipFile(filename) as archive:
+        with archive.open(name + '.npy') as member:
+            shape, fortran_order, dtype = npz_header(member)
+            if fortran_order or dtype.hasobject:
+                raise ValueError('%s of %s is not a C-ordered numeric array' %(name, filename))
+            row_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+            for start in range(0, shape[0], batch_size):
+                rows = min(batch_size, shape[0] - start)
+                block = np.frombuffer(member.read(rows * row_bytes), dtype=dtype)
+                yield start, block.reshape((rows,) + tuple(shape[1:]))
+
 #getting extra things from the original files
-def reading_binned_json():
-    feat_count_id = 0
-    massArray = np.arange(0,2000,0.1)
-    spectra_list = []
-    quality = 1 #1 means high quality spectra, 0 means low
-    
-    #make a list of all files/in path to open
-    all_directories = [x[0] for x in os.walk('./output_nf')]
-    files_to_open = [os.path.join(x, 'ready_array.npz') for x in all_directories]
-    counter = 0
-    #oop over all files with info
-    for filepath in files_to_open:
-        if os.path.isfile(filepath):
-            pass
-        else:
-            print("File Does Not Exist")
-            continue
-
-        data_load = np.load(filepath, allow_pickle=True) 
-        data = data_load['arr_0']
-        print(data.shape)
-        for scan_list in data:
-            #a lot of these are empty, we want to skip em
-            if len(scan_list) > 0:
-                #print(scan_list[0][quality])
-                counter +=1
-                #scan_list_quality = scan_list[0][quality]
-                #looping through a scan dict to extract info
-                #or key,value in scan_list_quality.items():
-                #   final_mass_list = []
-                #   final_inten_list = []
-                    
-                #   if key == 'retentionTime':
-                #       precursorRT = value
-                #   elif key == 'precursorMz':
-                #       precursorMass = value
-                #   elif key == 'precursorIntensity':
-                #       precursorIntensity = value
-                #   elif key == 'intensity array':
-                #       intensityArray = value
-                #   else: 
-                #       print("weird lack of key")
-                #getting rid of blank spectra values 
-                #or inten, mass in zip(intensityArray, massArray):
-                #   if inten != 0:
-                #       final_mass_list.append(mass)
-                #       final_inten_list.append(inten)
-                #writing the scan to a spectra list
-                #spectra_list, feat_id_count = format_mgf(feat_count_id, precursorMass, final_mass_list, final_inten_list, spectra_list)
-                #feat_id_count += 1
-    print(counter)
-    print(len(spectra_list))
-    write_mgf(spectra_list)
-            
+def reading_binned_json(path='./output_nf', output='./GNPS2.mgf', quality=1, batch_size=1000):
+    '''
+    writes the low (quality 0) or high (quality 1) spectra of every outdir under path to one mgf
+    ready_pairs.npz outdirs give every spectrum used on that side once,
+    ready_array2.npz outdirs one spectrum per pair with the precursor values of ready_array.npz
+    '''
+    with MGFWriter(output) as writer:
+        for directory, dirnames, filenames in os.walk(path):
+            if 'ready_pairs.npz' in filenames:
+                filepath = os.path.join(directory, 'ready_pairs.npz')
+                data = np.load(filepath)
+                attrs = dict((key, data[key]) for key in ['mz_min', 'bin_width'] if key in data)
+                spectra = scipy.sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+                rows = np.unique(data['pairs'][:, quality])
+                for start in range(0, len(rows), batch_size):
+                    batch_rows = rows[start:start + batch_size]
+                    batch = spectra[batch_rows]
+                    writer.write_peaks(batch.indptr, spectra_hdf5.peak_mz(batch.indices, attrs), batch.data, data['precursorMz'][batch_rows],
+                                        data['retentionTime'][batch_rows], data['precursorIntensity'][batch_rows], filepath)
+            elif 'ready_array2.npz' in filenames:
+                filepath = os.path.join(directory, 'ready_array2.npz')
+                with np.load(filepath) as data:
+                    attrs = dict((key, data[key]) for key in ['mz_min', 'bin_width'] if key in data)
+                pairs = npz_shape(filepath)[0]
+                metadata = None
+                if 'ready_array.npz' in filenames: #rt, precursor intensity and precursor m/z of the (low, high) scans of every pair
+                    metadata = np.load(os.path.join(directory, 'ready_array.npz'), allow_pickle=True)['arr_0']
+                    if metadata.dtype == object or metadata.ndim != 3 or len(metadata) != pairs:
+                        print('ignoring the metadata of %s' %directory)
+                        metadata = None
+                for start, peaks in npz_blocks(filepath, batch_size): #pairs of binned spectra, read a block at a time
+                    stop = start + len(peaks)
+                    if metadata is not None:
+                        rt, precursor_intensity, pepmass = metadata[start:stop, quality].T
+                    else:
+                        rt, precursor_intensity, pepmass = None, None, np.zeros(stop - start)
+                    writer.write_binned(peaks[:, quality], attrs, pepmass, rt, precursor_intensity, filepath)
 
 def main():
-    #parser = argparse.ArgumentParser(description='Parse hdf5 files to mgf.')
-    #parser.add_argument('input_hdf5')
-    #parser.add_argument('target_dset')
-
-    #input_file = args.input_hdf5
-    #target_dset = args.target_df
+    parser = argparse.ArgumentParser(description='write predicted or extracted spectra to an mgf for GNPS')
+    parser.add_argument('input', help='predictions (.hdf5 or .npy) or a directory of extraction outdirs')
+    parser.add_argument('--output', default='./GNPS2.mgf')
+    parser.add_argument('--dataset', default='predictions', help='dataset of the predictions hdf5')
+    parser.add_argument('--metadata', help='hdf5 the predictions were made from, gives PEPMASS, RTINSECONDS and PRECURSORINTEN')
+    parser.add_argument('--side', choices=['low', 'high'], default='high', help='spectra of the pairs to write')
+    parser.add_argument('--batch_size', type=int, default=1000, help='spectra converted and written at a time')
+    parser.add_argument('--top_k', type=int, default=None, help='keep only the k most intense peaks of every spectrum')
+    parser.add_argument('--threshold', type=float, default=None, help='keep only peaks above this fraction of the most intense peak')
+    args = parser.parse_args()
 
-    reading_binned_json()
+    side = 0 if args.side == 'low' else 1
+    if os.path.isdir(args.input):
+        reading_binned_json(args.input, args.output, quality=side, batch_size=args.batch_size)
+    else:
+        export_predictions(args.input, args.output, args.dataset, args.metadata, side, args.batch_size, args.top_k, args.threshold)
 
     #npy_read('predictions.npy')
     #pickle_read('./models_new/autoencoder/autoencoderhistory.pickle')
@@ -1,6 +1,7 @@
 import ms2_model
 import numpy as np
 import h5py
+import os
 from os.path import join
 import argparse
 
@@ -9,6 +10,13 @@ parser.add_argument('data', help='training data')
 parser.add_argument('model', help='select the model being trained')
 parser.add_argument('path', help='directory path, differs based on user/system')
 parser.add_argument('--val_data', help='validation data')
+parser.add_argument('--prefetch', type=int, default=0, help='threads reading batches ahead of training, 0 uses the plain generator')
+parser.add_argument('--shuffle', action='store_true', help='shuffle hdf5 chunks and the rows of a buffer of chunks every epoch')
+parser.add_argument('--seed', type=int, default=None, help='seed of the shuffle')
+parser.add_argument('--cache', help='directory of an uncompressed memmap copy of the data, compiled on first use')
+parser.add_argument('--cache_dtype', default='float32', help='dtype of the memmap cache, float32 or float16')
+parser.add_argument('--rebin', type=int, default=1, help='sum this many adjacent bins while reading, e.g. 100 turns 0.01 Da data into 1 Da')
+parser.add_argument('--quiet', action='store_true', help='drop the per batch prints of the generators')
 
 args = parser.parse_args()
 data = args.data
@@ -18,42 +26,56 @@ val_data = args.val_data
 
 outdir = join(path, 'models_new/')
 
-f = h5py.File(data, 'r')
-dataset_low = f['low_peaks']
-dataset_high = f['high_peaks']
+if args.quiet:
+    ms2_model.VERBOSE = False
+
+if args.cache:
+    if not ms2_model.memmap_current(args.cache, data, dtype=args.cache_dtype): #missing, or compiled from another file
+        ms2_model.compile_memmap(data, args.cache, dtype=args.cache_dtype)
+    cache = ms2_model.load_memmap(args.cache, data)
+    dataset_low = cache['low_peaks']
+    dataset_high = cache['high_peaks']
+else:
+    f = h5py.File(data, 'r')
+    dataset_low = ms2_model.load_dataset(f, 'low_peaks')
+    dataset_high = ms2_model.load_dataset(f, 'high_peaks')
+if args.rebin > 1:
+    dataset_low = ms2_model.RebinnedDataset(dataset_low, args.rebin)
+    dataset_high = ms2_model.RebinnedDataset(dataset_high, args.rebin)
 print(dataset_high.shape)
+input_size = ms2_model.input_size(dataset_low) #bins recorded by concat_hdf5
 
 if args.val_data:
     g = h5py.File(val_data, 'r')
-    X_val = g['low_peaks']
-    y_val = g['high_peaks']
+    X_val = ms2_model.load_dataset(g, 'low_peaks')
+    y_val = ms2_model.load_dataset(g, 'high_peaks')
 else:
     print('no val data')
 
 #ms2_model.session_config(1)
 
 if model=='conv1d':
-    model = ms2_model.model_Conv1D()
-    model = ms2_model.fit_model(model, dataset_low, dataset_high)
+    model = ms2_model.model_Conv1D(input_size)
+    model = ms2_model.fit_model(model, dataset_low, dataset_high, prefetch=args.prefetch, shuffle=args.shuffle, seed=args.seed)
     ms2_model.save_model(model, join(outdir, 'conv1d/', 'conv1d.h5'))
     ms2_model.save_history(model.history, join(outdir, 'conv1d/', 'conv1d_history.pickle'))
 
 elif model=='deepautoencoder':
-    autoencoder = ms2_model.model_deep_autoencoder()
-    autoencoder = ms2_model.fit_model(autoencoder, dataset_high, dataset_high)
+    autoencoder = ms2_model.model_deep_autoencoder(input_size)
+    autoencoder = ms2_model.fit_model(autoencoder, dataset_high, dataset_high, prefetch=args.prefetch, shuffle=args.shuffle, seed=args.seed)
     ms2_model.save_model(autoencoder, join(outdir, 'deepautoencoder/', 'deepautoencoder.h5'))
     ms2_model.save_history(autoencoder.history, join(outdir, 'deepautoencoder/', 'deepautoencoder_history.pickle'))
 
 elif model=='autoencoder':
-    autoencoder = ms2_model.model_autoencoder()
+    autoencoder = ms2_model.model_autoencoder(input_size)
     #autoencoder = ms2_model.fit_val_model2(autoencoder, dataset_low, dataset_high)
-    autoencoder = ms2_model.fit_model(autoencoder, dataset_high, dataset_high)
+    autoencoder = ms2_model.fit_model(autoencoder, dataset_high, dataset_high, prefetch=args.prefetch, shuffle=args.shuffle, seed=args.seed)
     ms2_model.save_model(autoencoder, join(outdir, 'autoencoder/', 'high_high_autoencoder.h5'))
     ms2_model.save_history(autoencoder.history, join(outdir, 'autoencoder/', 'high_autoencoderhistory.pickle'))
 
 elif model=='variationalautoencoder':
     autoencoder = ms2_model.model_variational_autoencoder()
-    autoencoder = ms2_model.fit_model(autoencoder, dataset_low, dataset_high)
+    autoencoder = ms2_model.fit_model(autoencoder, dataset_low, dataset_high, prefetch=args.prefetch, shuffle=args.shuffle, seed=args.seed)
     ms2_model.save_model(autoencoder, join(outdir, 'variationalautoencoder.h5'))
 
 print('operations complete')